@@ -0,0 +1,303 @@
+#!/usr/bin/python2.7
+
+import os
+import sys
+import json
+import platform
+import subprocess
+import math
+import multiprocessing
+import numpy as np
+from timeit import default_timer as timer
+from sconf import parser_init, parser, log_conf, now
+from simu_lib import Data, Simulator, FR_VARS, fr_block, pi, pi2
+from simu_shm import SharedVars, SharedParams, Control
+from simu_ode import benchmark_dopri
+from simu_qif import sharded_scaling
+
+__author__ = 'jm'
+
+""" Benchmark suite, without display. Every benchmark is repeated --repeat times and the best and
+    median times are stored in a JSON file, together with the commit and the machine, so that
+    the results of different commits can be compared:
+
+        python benchmark.py -out before.json
+        git checkout <commit> && python benchmark.py -out after.json
+
+    fr_loop: (firing-rate loop of main.simulation, a Simulator on SharedVars in blocks of 1000 steps)
+    fr_speedup: (block kernel fr_block against the step by step loop it replaced)
+    qif_scaling: (steps/s of the sharded QIF network with 1 to 16 workers, simu_qif.sharded_scaling)
+    dopri: (time of the Euler kernel and of the Dormand-Prince integrator at equal error, simu_ode.benchmark_dopri)
+    data_init: (Data.__init__, allocation of the buffers)
+    shared_memory: (shared memory set up by MainGui.__init__: SharedVars, SharedParams and Control)
+    plot_frame: (one Graph frame, Graph._plotpoints and Graph._blit, on an offscreen Agg canvas)
+    config: (sconf.parser loading of the configuration file)
+    cold_start: (main.py --headless from the interpreter start to the end of a short run)
+"""
+
+# -- Benchmark configuration I: parsing, debugging.
+conf_file, debug, args1, hlp = parser_init(default_file="bench_conf.txt")
+if not hlp:
+    logger = log_conf(debug, name='benchmark')
+else:
+    logger = None
+# -- Benchmark configuration II: data entry (second parser).
+description = 'Benchmark suite of the simulation, plotting and configuration code.'
+opts, args = parser(conf_file, args1, description=description)
+
+
+def measure(func, repeat):
+    """ Runs ``func`` (which returns the time to be measured, or None to time the whole call)
+        ``repeat`` times.
+    :return: dictionary with the 'best' and 'median' times (s) and all the 'times'.
+    """
+    times = []
+    for _ in xrange(repeat):
+        time1 = timer()
+        elapsed = func()
+        times.append(timer() - time1 if elapsed is None else elapsed)
+    return {'best': min(times), 'median': float(np.median(times)), 'times': times}
+
+
+def simulation_options(config, **changes):
+    """ Options of the simulation configuration file (as main.py reads them), with ``changes``."""
+    options, _ = parser(config, (None, []))
+    options.update(changes)
+    return options
+
+
+def bench_fr_loop(config, dts, tfinals, repeat):
+    results = []
+    for dt in dts:
+        for tfinal in tfinals:
+            def run():
+                data = Data(simulation_options(config, dt=dt, tfinal=tfinal, system='fr', nos=True))
+                sim = Simulator(data, SharedVars(data.vars, data.dtype), blocksize=1000)
+                time1 = timer()
+                sim.run(data.nsteps)
+                return timer() - time1
+            result = measure(run, repeat)
+            result.update({'dt': dt, 'tfinal': tfinal, 'steps': int(np.ceil(tfinal / dt)),
+                           'steps/s': np.ceil(tfinal / dt) / result['best']})
+            logger.info("fr_loop dt = %g, tfinal = %g: %.0f steps/s." % (dt, tfinal, result['steps/s']))
+            results.append(result)
+    return results
+
+
+def fr_loop_reference(var, tsteps, p, dt, nsteps):
+    """ Step by step version of the firing-rate loop, as it was written in main.simulation before the
+        block kernel (simu_lib.fr_block).
+    """
+    re, ve, se, ri, vi, si = [var[key] for key in FR_VARS]
+    kp = 0
+    for t in xrange(tsteps):
+        kp = t % nsteps
+        k = (t + nsteps - 1) % nsteps
+        re[kp] = re[k] + dt / p['taume'] * (p['delta'] / pi / p['taume'] + 2.0 * re[k] * ve[k])
+        ve[kp] = ve[k] + dt / p['taume'] * (ve[k] ** 2 + p['etae'] - pi2 * (re[k] * p['taume']) ** 2
+                                            - p['taume'] * p['jc'] * si[k])
+        se[kp] = se[k] + dt / p['taude'] * (-se[k] + re[kp])
+
+        ri[kp] = ri[k] + dt / p['taumi'] * (p['delta'] / p['taumi'] / pi + 2.0 * ri[k] * vi[k])
+        vi[kp] = vi[k] + dt / p['taumi'] * (vi[k] ** 2 + p['etai'] - p['taumi'] ** 2 * pi2 * ri[k] ** 2
+                                            + p['taumi'] * p['jc'] * se[k] - p['taumi'] * p['js'] * si[k])
+        si[kp] = si[k] + dt / p['taudi'] * (-si[k] + ri[kp])
+
+        if math.isnan(re[kp]) or math.isnan(ri[kp]):
+            break
+    return kp
+
+
+def bench_fr_speedup(config, dts, tfinal, repeat, blocksize=10000):
+    """ Throughput of the step by step loop and of the block kernel over the same steps, starting
+        from the initial conditions of the configuration (the buffers are copied for every run).
+    """
+    results = []
+    for dt in dts:
+        data = Data(simulation_options(config, dt=dt, tfinal=tfinal, system='fr'))
+        nsteps, p = data.nsteps, dict(data.prmts)
+
+        def reference():
+            var = dict([(key, np.array(data.vars[key])) for key in FR_VARS])
+            time1 = timer()
+            fr_loop_reference(var, nsteps, p, dt, nsteps)
+            return timer() - time1
+
+        def block():
+            var = dict([(key, np.array(data.vars[key])) for key in FR_VARS])
+            time1 = timer()
+            k, done = nsteps - 1, 0
+            while done < nsteps:
+                nblock = min(blocksize, nsteps - done)
+                n = fr_block(var, k, nblock, p, dt, nsteps)
+                done += nblock
+                k = (k + n) % nsteps
+                if n < nblock:
+                    break
+            return timer() - time1
+        tref, tblock = measure(reference, repeat), measure(block, repeat)
+        result = {'dt': dt, 'steps': nsteps, 'reference': nsteps / tref['best'], 'block': nsteps / tblock['best'],
+                  'speedup': tref['best'] / tblock['best']}
+        logger.info("fr_speedup dt = %g: reference loop %.0f steps/s, block kernel %.0f steps/s (x%.1f)."
+                    % (dt, result['reference'], result['block'], result['speedup']))
+        results.append(result)
+    return results
+
+
+def bench_qif_scaling(config, neurons, workers, dt):
+    data = Data(simulation_options(config, dt=dt, system='fr'))
+    rates = sharded_scaling(neurons, data.prmts, dt, workers=workers)
+    result = {'neurons': neurons, 'dt': dt, 'steps/s': dict([(str(nw), rate) for nw, rate in rates.items()])}
+    logger.info("qif_scaling N = %d: %s." % (neurons, ', '.join(['%d workers %.0f steps/s' % (nw, rates[nw])
+                                                                  for nw in sorted(rates)])))
+    return result
+
+
+def bench_dopri(config, dts, tfinal):
+    results = []
+    for dt in dts:
+        data = Data(simulation_options(config, dt=dt, tfinal=tfinal, system='fr'))
+        x0 = [float(data.vars[key][data.nsteps - 1]) for key in FR_VARS]
+        result = benchmark_dopri(dict(data.prmts), x0, dt, tfinal)
+        result.update({'dt': dt, 'tfinal': tfinal})
+        logger.info("dopri at error %.1e: Euler dt = %g %.3f s, Dormand-Prince rtol = %.1e %.3f s (x%.1f)."
+                    % (result['error'], dt, result['euler_time'], result['dopri_rtol'], result['dopri_time'],
+                       result['speedup']))
+        results.append(result)
+    return results
+
+
+def bench_data_init(config, sizes, repeat):
+    results = []
+    for nsteps in sizes:
+        options = simulation_options(config, t0=0.0, dt=1.0, tfinal=float(nsteps), system='fr')
+        result = measure(lambda: Data(options) and None, repeat)
+        result.update({'nsteps': nsteps, 'bytes/s': 7 * 8 * nsteps / result['best']})
+        logger.info("data_init nsteps = %d: %.3f s." % (nsteps, result['best']))
+        results.append(result)
+    return results
+
+
+def bench_shared_memory(config, sizes, repeat):
+    results = []
+    for nsteps in sizes:
+        data = Data(simulation_options(config, t0=0.0, dt=1.0, tfinal=float(nsteps), system='fr'))
+        for pyramid in (False, True):
+            def setup():
+                SharedVars(data.vars, data.dtype, pyramid=pyramid)
+                SharedParams(data.prmts)
+                Control()
+            result = measure(setup, repeat)
+            result.update({'nsteps': nsteps, 'pyramid': pyramid})
+            logger.info("shared_memory nsteps = %d, pyramid %s: %.3f s." % (nsteps, pyramid, result['best']))
+            results.append(result)
+    return results
+
+
+def bench_plot_frame(config, sizes, repeat):
+    """ Graph needs Gtk, so its frame is reproduced on an Agg canvas with the same calls:
+        envelope of the visible interval with one point per pixel, set_data, and restore_region /
+        draw_artist / blit over the cached background (and a full draw for comparison).
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        logger.warning("plot_frame skipped: matplotlib is not installed.")
+        return {'skipped': 'matplotlib is not installed'}
+    results = []
+    for nsteps in sizes:
+        data = Data(simulation_options(config, t0=0.0, dt=1.0, tfinal=float(nsteps), system='fr'))
+        var = SharedVars(data.vars, data.dtype)
+        sim = Simulator(data, var, blocksize=10000)
+        sim.run(min(nsteps, 100000))
+        fig = plt.Figure(figsize=(10, 6.25), dpi=80)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        line, = ax.plot([0, 1], [0, 1], animated=True)
+        ax.set_xlim(0, nsteps)
+        ax.set_ylim(0, 2)
+        canvas.draw()
+        background = canvas.copy_from_bbox(ax.bbox)
+        t = var['t']
+        npixels = int(ax.bbox.width)
+
+        def frame(blit=True):
+            seq, tstep, pending = var.snapshot()
+            positions, ymin, ymax = var.envelope('re', tstep, pending, nsteps, npixels)
+            line.set_data(np.repeat(t[positions], 2), np.column_stack((ymin, ymax)).ravel())
+            if blit:
+                canvas.restore_region(background)
+                ax.draw_artist(line)
+                canvas.blit(ax.bbox)
+            else:
+                canvas.draw()
+        for blit in (True, False):
+            result = measure(lambda: frame(blit), repeat)
+            result.update({'nsteps': nsteps, 'blit': blit, 'pixels': npixels})
+            logger.info("plot_frame nsteps = %d, blit %s: %.2f ms." % (nsteps, blit, 1e3 * result['best']))
+            results.append(result)
+    return results
+
+
+def bench_config(config, repeat):
+    result = measure(lambda: parser(config, (None, [])) and None, repeat)
+    logger.info("config: %.2f ms." % (1e3 * result['best']))
+    return result
+
+
+def bench_cold_start(config, repeat):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'main.py'),
+               '-f', config, '-hl', '-nos', '-tfinal', '1.0', '-db', 'ERROR']
+    devnull = open(os.devnull, 'w')
+
+    def run():
+        if subprocess.call(command, stdout=devnull, stderr=devnull):
+            raise RuntimeError("main.py --headless failed: %s" % ' '.join(command))
+    result = measure(run, repeat)
+    devnull.close()
+    logger.info("cold_start (headless): %.2f s." % result['best'])
+    return result
+
+
+def machine():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+                                         cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'date': '%s %s' % now('-', ':'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': multiprocessing.cpu_count()}
+
+
+if __name__ == '__main__':
+    skip = set(args.skip)
+    results = {'machine': machine(), 'options': {'config': args.conf, 'repeat': args.rep}}
+    time0 = timer()
+    if 'fr_loop' not in skip:
+        results['fr_loop'] = bench_fr_loop(args.conf, args.dt, args.tfinal, args.rep)
+    if 'fr_speedup' not in skip:
+        results['fr_speedup'] = bench_fr_speedup(args.conf, args.dt, min(args.tfinal), args.rep)
+    if 'qif_scaling' not in skip:
+        results['qif_scaling'] = bench_qif_scaling(args.conf, args.N, args.workers, max(args.dt))
+    if 'dopri' not in skip:
+        results['dopri'] = bench_dopri(args.conf, args.dt, min(args.tfinal))
+    if 'data_init' not in skip:
+        results['data_init'] = bench_data_init(args.conf, args.nsteps, args.rep)
+    if 'shared_memory' not in skip:
+        results['shared_memory'] = bench_shared_memory(args.conf, args.nsteps, args.rep)
+    if 'plot_frame' not in skip:
+        results['plot_frame'] = bench_plot_frame(args.conf, args.nsteps, args.rep)
+    if 'config' not in skip:
+        results['config'] = bench_config(args.conf, args.rep)
+    if 'cold_start' not in skip:
+        results['cold_start'] = bench_cold_start(args.conf, args.rep)
+
+    output = args.out or 'benchmarks/bench_%s_%s.json' % now('-', '-')
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logger.info("Benchmarks done in %.1f s, results saved in %s." % (timer() - time0, output))
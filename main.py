@@ -1,33 +1,26 @@
 #!/usr/bin/python2.7
 
+import os
 import sys
+import json
+import time
+from timeit import default_timer as timer
+start = timer()  # Cold start: imports, configuration and allocation of the variables
 import numpy as np
 import math
 import logging
-from sconf import parser_init, parser, log_conf
-from simu_lib import Data
-from simu_gui import MainGui
+from sconf import parser_init, parser, log_conf, now
+from simu_lib import Data, Simulator, FR_VARS
+from simu_bif import AttractorDetector
+from simu_io import HistoryWriter, checkpoint, save_checkpoint
+from simu_qif import QIF_VARS
+from simu_shm import Counters
+from simu_prof import Profiler, StepTimeHistogram
+from simu_spec import WelchPSD, FREQ_VARS
+from simu_sweep import sample_initial_states, basin_map, initial_state
 import progressbar as pb
-from timeit import default_timer as timer
-
-import gi
-
-try:
-    gi.require_version("GObject", "2.0")
-except ValueError:
-    logging.exception("Requires GObject development files to be installed.")
-except AttributeError:
-    logging.exception("pygobject version too old.")
-
-gi.require_version('Gtk', '3.0')
-
-from gi.repository import Gtk, GObject
-
-import Gnuplot
 
-# Use this option to turn off fifo if you get warnings like:
-# line 0: warning: Skipping unreadable file "/tmp/tmpakexra.gnuplot/fifo"
-Gnuplot.GnuplotOpts.prefer_fifo_data = 0
+# The GUI and plotting modules (gi, Gtk, matplotlib, Gnuplot) are imported at the end, only without --headless
 
 __author__ = 'jm'
 
@@ -36,6 +29,7 @@ pi2 = np.pi * np.pi
 
 # -- Simulation configuration I: parsing, debugging.
 conf_file, debug, args1, hlp = parser_init()
+profile = vars(args1[0])['prof']  # None, 'deterministic' or 'sampling' (--profile)
 if not hlp:
     logger = log_conf(debug)
 else:
@@ -52,17 +46,19 @@ opts, args = parser(conf_file, args1, description=description)  # opts is a dict
 data = Data(opts)
 
 
-def simulation(dat, var, q_in=None, q_out=None, updaterate=10000):
+def simulation(dat, var, ctrl=None, prm=None, q_out=None, updaterate=1000, counters=None):
+    """ Simulation process. The systems are advanced in blocks of ``updaterate`` steps by a
+        simu_lib.Simulator; the control plane (commands, progress bar, saving and attractor
+        detection) is only visited between blocks. Pause, step, stop and exit come from
+        ``ctrl`` (simu_shm.Control), new parameters from the shared block ``prm``
+        (simu_shm.SharedParams) when its version changes. Throughput, control overhead and
+        parameter latency are added to ``counters`` (simu_shm.Counters).
+    """
     d = dat
     p = dat.prmts
-    p.update(dat.controls)
-    re, ve, se, ri, vi, si = (var['re'], var['ve'], var['se'],
-                              var['ri'], var['vi'], var['si'])
-
-    try:
-        p.update(q_in.get_nowait())
-    except:
-        pass
+    if profile:
+        profiler = Profiler('simulation', profile).start()
+        steptimes = StepTimeHistogram()
 
     # Progress-bar configuration
     widgets = ['Progress: ', pb.Percentage(), ' ',
@@ -79,72 +75,214 @@ def simulation(dat, var, q_in=None, q_out=None, updaterate=10000):
         # noinspection PyTypeChecker
         pbar = pb.ProgressBar(max_value=pb.UnknownLength)
 
+    version = prm.update(p) if prm is not None else None
+
     time1 = timer()
     tstep = 0
-    temps = 0.0
+    tsteps = int(math.ceil(d.tfinal * args.loop / d.dt))
     kp = k = 0
 
     np.seterr(all='raise')
 
+    sim = Simulator(d, var, updaterate)
+    if d.save:
+        names = [key for key in FR_VARS + QIF_VARS if key in var]
+        if d.minimal:
+            names = [key for key in names if key[0] == 'r']
+        filename = d.output or 'results/simulation_%s_%s.npy' % now('-', '-')
+        writer = HistoryWriter(filename, names, d.dt, d.t0 + d.elapsed, d.decimate)
+    else:
+        writer = None
+    if 'fr' in d.systems and d.autostop != 'none':
+        detector = AttractorDetector(d.dt, dtype=d.dtype)
+    else:
+        detector = None
+
+    if d.freq and 'fr' in d.systems:
+        spectrum = WelchPSD(FREQ_VARS, d.dt, d.fwindow)
+    else:
+        spectrum = None
+
+    def frequencies(v, k0, n):
+        """ Running spectrum: the dominant frequencies are stored in the buffers 'fre', 'fri', 'fse' and
+            'fsi', written with the block (before it is published, see Simulator.advance).
+        """
+        block = (k0 + 1 + np.arange(n)) % d.nsteps
+        spectrum.update([v[key][block] for key in FREQ_VARS])
+        for key, frequency in zip(FREQ_VARS, spectrum.dominant()[0]):
+            v['f' + key][block] = frequency
+    # Checkpoints every d.checkpoint time units, written in the background (see --external to restart)
+    stamp = '%s_%s' % now('-', '-')
+    keys = sorted([key for key in var.keys() if key not in ('t', 'tstep')])
+    savings = []
+
+    def save(wait=False):
+        filename = 'results/checkpoint_%s_t%g.npz' % (stamp, d.elapsed + tstep * d.dt)
+        savings.append(save_checkpoint(filename, checkpoint(var, keys, tstep, p, d.dt, d.elapsed), wait))
+        saved[0] = tstep
+    saved = [0]  # tstep of the last checkpoint
+    next_checkpoint = d.checkpoint
+
+    mark, idle = timer(), 0.0  # End of the last block, time slept in ctrl.wait()
     # Time loop: (if loop was 0 in the config step,
     #             we can break the time-loop by changing "loop"
     #             or explicitly with a break)
-    while temps < d.tfinal * args.loop:
-        while p['pause']:
-            try:
-                p.update(q_in.get_nowait())
-            except:
-                pass
-        # Time step variables
-        kp = tstep % d.nsteps
+    while tstep < tsteps:
+        # Sleeps while paused, returns the steps allowed by a "step" command
+        allowed = ctrl.wait() if ctrl is not None else None
+        if allowed == 0:
+            break
+        if prm is not None and prm.version != version:
+            version = prm.update(p)
+            sim.set_params()
+            if counters is not None:
+                counters.add('params')
+                counters.add('param_latency', time.time() - prm.stamp)
+            if detector is not None:
+                detector.reset()
+        # Block variables: last computed step and length of the block
         k = (tstep + d.nsteps - 1) % d.nsteps
-        if tstep == 0:
-            logger.debug("Initial firing rate values: (%f, %f)" % (ri[k], ri[k]))
-
-        if d.sys in ('fr', 'both'):
-            re[kp] = re[k] + d.dt / p['taume'] * (p['delta'] / pi / p['taume'] + 2.0 * re[k] * ve[k])
-            ve[kp] = ve[k] + d.dt / p['taume'] * (ve[k] ** 2 + p['etae'] - pi2 * (re[k] * p['taume']) ** 2
-                                                  - p['taume'] * p['jc'] * si[k])
-            se[kp] = se[k] + d.dt / p['taude'] * (-se[k] + re[kp])
-
-            ri[kp] = ri[k] + d.dt / p['taumi'] * (p['delta'] / p['taumi'] / pi + 2.0 * ri[k] * vi[k])
-            vi[kp] = vi[k] + d.dt / p['taumi'] * (vi[k] ** 2 + p['etai'] - p['taumi'] ** 2 * pi2 * ri[k] ** 2
-                                                  + p['taumi'] * p['jc'] * se[k] - p['taumi'] * p['js'] * si[k])
-            si[kp] = si[k] + d.dt / p['taudi'] * (-si[k] + ri[kp])
-
-            if math.isnan(re[kp]) or math.isnan(ri[kp]):
-                logger.error("Overflow encountered! Change parameters before running a new instance of the simulation.")
-                break
+        nblock = min(updaterate, d.nsteps, tsteps - tstep, allowed or updaterate)
+        if tstep == 0 and 'fr' in d.systems:
+            logger.debug("Initial firing rate values: (%f, %f)" % (var['re'][k], var['ri'][k]))
 
-        pbar.update(tstep)
-        if p['exit'] or p['stop']:
+        time2 = timer()
+        k, done = sim.advance(nblock, frequencies if spectrum is not None else None)
+        time3 = timer()
+        if counters is not None:
+            slept = ctrl.idle - idle if ctrl is not None else 0.0
+            idle += slept
+            counters.add('control', time2 - mark - slept)
+            counters.add('compute', time3 - time2)
+            counters.add('steps', done)
+            counters.add('blocks')
+        mark = time3
+        if profile:
+            steptimes.add(time3 - time2, done)
+        if writer is not None and done:
+            writer.push(var, k, done, tstep)
+        tstep = sim.tstep
+        kp = sim.k
+        if sim.diverged:
             break
 
-        temps += d.dt
-        tstep += 1
-        var['tstep'].value = tstep
+        if ctrl is not None:
+            ctrl.consume(done)
+        pbar.update(tstep)
+        if d.checkpoint and tstep * d.dt >= next_checkpoint:
+            save()
+            next_checkpoint += d.checkpoint
 
-        # We get the data from the GUI
-        if q_in and tstep % updaterate == 0:
-            try:
-                p.update(q_in.get_nowait())
-            except:
-                pass
+        index = (k + 1 + np.arange(done)) % d.nsteps
+        # Has the trajectory reached a fixed point or a periodic orbit?
+        if detector is not None:
+            found = detector.update(np.array([var[key][index] for key in FR_VARS]).T, p)
+            if found and found['type'] == 'fixed point':
+                logger.info("Fixed point (%s) reached at t = %.3f: re = %f, ri = %f."
+                            % (found['stability'], tstep * d.dt, found['x'][0], found['x'][3]))
+            elif found:
+                logger.info("Limit cycle reached at t = %.3f: period = %f, amplitude of re = %f."
+                            % (tstep * d.dt, found['period'], found['amplitude']))
+            if found and (d.autostop == 'stop' or ctrl is None):
+                break
+            elif found:
+                # Resuming does not pause again on the same attractor, the detector is re-armed by new parameters
+                ctrl.pause()
     # Finish pbar
     pbar.finish()
-    temps -= d.dt
-    tstep -= 1
-    print temps, re[kp], ri[kp]
+    sim.close()
+    if writer is not None:
+        writer.close()
+    if d.checkpoint and tstep != saved[0]:
+        save(wait=True)
+    for thread in savings:
+        thread.join()
+    if spectrum is not None and spectrum.segments:
+        frequencies, fractions = spectrum.dominant()
+        logger.info("Dominant frequencies: %s." % ', '.join(['%s %.4f (%.0f%% of the power)' % (key, f, 100 * r)
+                                                              for key, f, r in zip(FREQ_VARS, frequencies, fractions)]))
+        if writer is not None:
+            np.save(writer.filename[:-4] + '_psd.npy', np.vstack((spectrum.freqs, spectrum.psd)))
+    if profile:
+        profiler.stop()
+        steptimes.dump('log/steptime_%d.txt' % os.getpid())
+    elapsed = timer() - time1
+    temps = (tstep - 1) * d.dt
+    if 'fr' in d.systems:
+        print temps, var['re'][kp], var['ri'][kp]
     # Stop the timer
-    print 'Total time: {}.'.format(timer() - time1)
+    print 'Total time: {}.'.format(elapsed)
+    logger.info("Throughput: %.0f steps/s (%d steps)." % (tstep / elapsed, tstep))
+    if counters is not None and counters['blocks']:
+        logger.info("Computing: %.3f s. Control: %.3f s (%.1f us per block). Parameter changes: %d (%.2f ms latency)."
+                    % (counters['compute'], counters['control'], 1e6 * counters['control'] / counters['blocks'],
+                       counters['params'], 1e3 * counters['param_latency'] / max(counters['params'], 1)))
     # q_out.put('Q')
 
 
+def started(mode):
+    logger.info("Cold start (%s): %.2f s." % (mode, timer() - start))
+    return False
+
+
+if args.ic:
+    # Basin-of-attraction map: many initial states integrated together (see simu_sweep.basin_map)
+    started('initconds')
+    if len(args.icr) != 8:
+        raise ValueError("--icranges needs min and max of re, ve, ri and vi (8 values).")
+    ranges = dict([(key, args.icr[2 * n:2 * n + 2]) for n, key in enumerate(('re', 've', 'ri', 'vi'))])
+    x0, shape = sample_initial_states(args.icn, ranges, initial_state(data), args.icm)
+    basins = basin_map(data.prmts, x0, data.dt, data.tfinal, window=args.icw)
+    attractors = basins.pop('attractors')
+    for key in ('state', 'min', 'max', 'count'):
+        basins['attractor_' + key] = np.array([attractor[key] for attractor in attractors])
+    basins['attractor_type'] = np.array([attractor.get('stability', attractor['type']) for attractor in attractors])
+    basins['shape'] = np.array(shape or (len(x0),))
+    basins['timing'] = np.array(json.dumps(basins['timing']))
+    filename = data.output or 'results/basins_%s_%s.npz' % now('-', '-')
+    if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    np.savez(filename, **basins)
+    logger.info("Basin map (%d states, %d attractors) saved to %s." % (len(x0), len(attractors), filename))
+    sys.exit(0)
+
+if args.hl:
+    # Headless run: no display, results are saved by simu_io.HistoryWriter (see --nosave, --output)
+    started('headless')
+    simulation(data, data.vars, counters=Counters())
+    sys.exit(0)
+
+import gi
+
+try:
+    gi.require_version("GObject", "2.0")
+except ValueError:
+    logging.exception("Requires GObject development files to be installed.")
+except AttributeError:
+    logging.exception("pygobject version too old.")
+
+gi.require_version('Gtk', '3.0')
+
+from gi.repository import Gtk, GObject
+
+import Gnuplot
+
+# Use this option to turn off fifo if you get warnings like:
+# line 0: warning: Skipping unreadable file "/tmp/tmpakexra.gnuplot/fifo"
+Gnuplot.GnuplotOpts.prefer_fifo_data = 0
+
+from simu_gui import MainGui
+
 # GUI initializing
 GObject.threads_init()
 # print Gtk.thread_supported()
 mg = MainGui(data, simulation=simulation)
 mg.window.show_all()
+GObject.idle_add(started, 'GUI')  # Once the main window is drawn
 
+if profile:
+    gui_profiler = Profiler('gui', profile).start()
 Gtk.main()
+if profile:
+    gui_profiler.stop()
 # Gdk.threads_leave()
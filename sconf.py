@@ -34,15 +34,19 @@ class Options:
         pass
 
 
-def parser_init():
+def parser_init(default_file="conf.txt"):
     """ Function to handle arguments from CLI:
         First Parsing -  We parse optional configuration files.
+        :param default_file: configuration file used when none is given with -f.
     """
 
     pars = argparse.ArgumentParser(add_help=False)
-    pars.add_argument('-f', '--file', default="conf.txt", dest='-f', metavar='<file>')
+    pars.add_argument('-f', '--file', default=default_file, dest='-f', metavar='<file>')
     pars.add_argument('-db', '--debug', default="DEBUG", dest='db', metavar='<debug>',
                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    # Profiling of the processes (see simu_prof), read it with vars(args[0])['prof']
+    pars.add_argument('-prof', '--profile', default=None, dest='prof', metavar='<profile>', nargs='?',
+                      const='deterministic', choices=['deterministic', 'sampling'])
     # Check for arguments matching the latter options
     args = pars.parse_known_args()
     conf_file = vars(args[0])['-f']  # Configuration file (if any)
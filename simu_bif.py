@@ -0,0 +1,279 @@
+import numpy as np
+import logging
+from timeit import default_timer as timer
+from simu_lib import pi, pi2, fr_field
+
+logging.getLogger('simu_bif').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Steady states of the E/I firing-rate equations (same vector field as main.simulation).
+
+    fr_jacobian: (analytic Jacobian of the vector field)
+    ************
+    fixed_point: (Newton iteration from an initial guess, with stability of the solution)
+    ************
+    continuation: (pseudo-arclength continuation of a branch of fixed points in one parameter)
+    *************
+    AttractorDetector: (online detection of convergence to a fixed point or to a limit cycle)
+    ******************
+"""
+
+
+def fr_jacobian(x, p):
+    """ Jacobian matrix of simu_lib.fr_field at the state x = (re, ve, se, ri, vi, si)."""
+    taume, taumi = float(p['taume']), float(p['taumi'])
+    taude, taudi = float(p['taude']), float(p['taudi'])
+    jc, js = float(p['jc']), float(p['js'])
+    re, ve, se, ri, vi, si = x
+    jac = np.zeros((6, 6))
+    jac[0, 0], jac[0, 1] = 2.0 * ve / taume, 2.0 * re / taume
+    jac[1, 0], jac[1, 1], jac[1, 5] = -2.0 * pi2 * taume * re, 2.0 * ve / taume, -jc
+    jac[2, 0], jac[2, 2] = 1.0 / taude, -1.0 / taude
+    jac[3, 3], jac[3, 4] = 2.0 * vi / taumi, 2.0 * ri / taumi
+    jac[4, 3], jac[4, 4], jac[4, 2], jac[4, 5] = -2.0 * pi2 * taumi * ri, 2.0 * vi / taumi, jc, -js
+    jac[5, 3], jac[5, 5] = 1.0 / taudi, -1.0 / taudi
+    return jac
+
+
+def fr_dparam(x, p, name, eps=1e-7):
+    """ Derivative of the vector field with respect to the parameter ``name`` (analytic for
+        delta, etae, etai, jc and js, finite differences for the time constants).
+    """
+    taume, taumi = float(p['taume']), float(p['taumi'])
+    re, ve, se, ri, vi, si = x
+    dfdp = np.zeros(6)
+    if name == 'delta':
+        dfdp[0], dfdp[3] = 1.0 / (pi * taume ** 2), 1.0 / (pi * taumi ** 2)
+    elif name == 'etae':
+        dfdp[1] = 1.0 / taume
+    elif name == 'etai':
+        dfdp[4] = 1.0 / taumi
+    elif name == 'jc':
+        dfdp[1], dfdp[4] = -si, se
+    elif name == 'js':
+        dfdp[4] = -si
+    else:
+        q = dict(p)
+        q[name] = float(p[name]) + eps
+        dfdp = (fr_field(q)(x) - fr_field(p)(x)) / eps
+    return dfdp
+
+
+def stability(jac):
+    """ Eigenvalues of the Jacobian and classification of the fixed point.
+    :return: (eigenvalues, label) with label in 'stable node', 'stable focus', 'saddle', 'unstable node',
+             'unstable focus'.
+    """
+    eigs = np.linalg.eigvals(jac)
+    unstable = np.sum(eigs.real > 0)
+    oscillatory = np.any(np.abs(eigs.imag) > 1e-12)
+    if unstable == 0:
+        label = 'stable focus' if oscillatory else 'stable node'
+    elif unstable == len(eigs):
+        label = 'unstable focus' if oscillatory else 'unstable node'
+    else:
+        label = 'saddle'
+    return eigs, label
+
+
+def fixed_point(p, x0, tol=1e-10, maxiter=50):
+    """ Fixed point of the firing-rate equations by Newton iteration with the analytic Jacobian.
+    :param p: dictionary of parameters.
+    :param x0: initial guess (re, ve, se, ri, vi, si), e.g. the last state of a simulation.
+    :return: dictionary with 'x', 'eigenvalues', 'stability', 'iterations', or None if it does not converge.
+    """
+    f = fr_field(p)
+    x = np.array(x0, dtype=float)
+    for n in xrange(maxiter):
+        fx = f(x)
+        if np.max(np.abs(fx)) < tol:
+            eigs, label = stability(fr_jacobian(x, p))
+            return {'x': x, 'eigenvalues': eigs, 'stability': label, 'iterations': n}
+        try:
+            dx = np.linalg.solve(fr_jacobian(x, p), -fx)
+        except np.linalg.LinAlgError:
+            return None
+        # Damped step: the rates must stay positive
+        lam = 1.0
+        while np.any(x[[0, 3]] + lam * dx[[0, 3]] <= 0) and lam > 1e-4:
+            lam *= 0.5
+        x = x + lam * dx
+        if not np.all(np.isfinite(x)):
+            return None
+    return None
+
+
+def continuation(p, name, x0, pmin, pmax, ds=0.01, dsmax=0.1, maxpoints=5000, tol=1e-10):
+    """ Pseudo-arclength continuation of the branch of fixed points through x0 in the parameter ``name``.
+        The branch is followed (in both directions) until it leaves [pmin, pmax]. Folds (LP) and
+        Hopf points (HB) are detected by changes of det(J) and of the number of unstable complex eigenvalues.
+    :param p: dictionary of parameters, p[name] is the starting value.
+    :param x0: initial guess of a fixed point at p[name].
+    :return: dictionary with 'param' (M,), 'x' (M, 6), 'stable' (M,), 'eigenvalues' (M, 6) and
+             'special' [(type, index)], ordered along the branch.
+    """
+    logger = logging.getLogger('simu_bif.continuation')
+    time1 = timer()
+    p = dict(p)
+    start = fixed_point(p, x0, tol)
+    if start is None:
+        raise ValueError("Newton iteration did not converge from the initial guess.")
+
+    def extended_jacobian(y):
+        p[name] = y[6]
+        return np.hstack((fr_jacobian(y[:6], p), fr_dparam(y[:6], p, name)[:, np.newaxis]))
+
+    def tangent(y, previous):
+        mat = np.vstack((extended_jacobian(y), previous))
+        rhs = np.zeros(7)
+        rhs[6] = 1.0
+        t = np.linalg.solve(mat, rhs)
+        return t / np.linalg.norm(t)
+
+    branches = []
+    y0 = np.append(start['x'], float(p[name]))
+    for direction in (1.0, -1.0):
+        guess = np.zeros(7)
+        guess[6] = direction
+        y, t, h = y0.copy(), tangent(y0, guess), ds
+        points = [y.copy()]
+        while len(points) < maxpoints and pmin <= y[6] <= pmax:
+            # Predictor along the tangent and Newton corrector on the arclength condition
+            yp = y + h * t
+            z = yp.copy()
+            converged = False
+            for it in xrange(10):
+                p[name] = z[6]
+                g = np.append(fr_field(p)(z[:6]), np.dot(t, z - yp))
+                if np.max(np.abs(g)) < tol:
+                    converged = True
+                    break
+                try:
+                    z -= np.linalg.solve(np.vstack((extended_jacobian(z), t)), g)
+                except np.linalg.LinAlgError:
+                    break
+            if not converged or not np.all(np.isfinite(z)) or min(z[0], z[3]) <= 0:
+                h *= 0.5
+                if h < 1e-8:
+                    logger.warning("Continuation stopped at %s = %f." % (name, y[6]))
+                    break
+                continue
+            t = tangent(z, t)
+            y = z
+            points.append(y.copy())
+            h = min(h * 1.3, dsmax) if it < 4 else h
+        branches.append(points)
+
+    ys = np.array(branches[1][::-1] + branches[0][1:])
+    inside = (ys[:, 6] >= pmin) & (ys[:, 6] <= pmax)
+    ys = ys[inside]
+    eigs, stable, dets, nhopf = [], [], [], []
+    for y in ys:
+        p[name] = y[6]
+        jac = fr_jacobian(y[:6], p)
+        ev = np.linalg.eigvals(jac)
+        eigs.append(ev)
+        stable.append(np.all(ev.real < 0))
+        dets.append(np.linalg.det(jac))
+        nhopf.append(np.sum((ev.real > 0) & (np.abs(ev.imag) > 1e-12)))
+    special = []
+    for i in xrange(1, len(ys)):
+        if np.sign(dets[i]) != np.sign(dets[i - 1]):
+            special.append(('LP', i))
+        elif nhopf[i] != nhopf[i - 1]:
+            special.append(('HB', i))
+    result = {'param': ys[:, 6], 'x': ys[:, :6], 'stable': np.array(stable), 'eigenvalues': np.array(eigs),
+              'special': special, 'name': name}
+    logger.info("Branch of %d points in %s = [%g, %g] computed in %.2f s. Special points: %s"
+                % (len(ys), name, pmin, pmax, timer() - time1,
+                   ', '.join(['%s at %s = %.4f' % (kind, name, ys[i, 6]) for kind, i in special]) or 'none'))
+    return result
+
+
+class AttractorDetector:
+    """ Online detector for a running firing-rate simulation. It is fed with every new block of the
+        trajectory and decides when it has reached
+            + a fixed point: the derivative stays below ``ftol`` during ``window`` time units.
+            + a periodic orbit: the last ``ncycles`` returns to the Poincare section re = (min + max) / 2
+              (upward crossings) have the same period (within ``ptol``) and cross at the same state
+              (within ``stol``, interpolation between steps limits its accuracy).
+        The trajectory is read in the precision of the buffers (``dtype``): the derivative of a state
+        stored at a fixed point is only known within a few rounding steps of the dtype divided by dt,
+        so ``ftol`` is raised to that level (float32 buffers). An attractor is reported once, the
+        detector stays silent until reset() (after a change of parameters).
+        The cost of an update is O(block).
+    """
+
+    def __init__(self, dt, window=10.0, ftol=1e-6, ptol=1e-4, stol=1e-2, ncycles=3, amin=1e-4, dtype=np.float64):
+        self.logger = logging.getLogger('simu_bif.AttractorDetector')
+        self.dt = dt
+        self.window = int(round(window / dt))
+        self.ftol, self.ptol, self.stol, self.ncycles, self.amin = ftol, ptol, stol, ncycles, amin
+        self.qtol = 4.0 * np.finfo(dtype).eps / dt  # Rounding of the stored states, relative to 1 + |x|
+        self.reset()
+
+    def reset(self):
+        """ Forget the trajectory (e.g. after a change of parameters)."""
+        self.t = 0.0
+        self.last = None
+        self.recent = np.empty(0)
+        self.quiet = 0
+        self.crossings = []
+        self.reported = False
+
+    def update(self, block, p):
+        """ Processes a new block of the trajectory.
+        :param block: array (n, 6) with the states (re, ve, se, ri, vi, si) of consecutive steps.
+        :param p: current parameters.
+        :return: None, or a dictionary describing the attractor: {'type': 'fixed point', 'x', 'stability', 't'}
+                 or {'type': 'limit cycle', 'period', 'amplitude', 'x', 't'}.
+        """
+        block = np.asarray(block, dtype=float)
+        n = len(block)
+        if n == 0 or self.reported:
+            return None
+        traj = block if self.last is None else np.vstack((self.last, block))
+        t0 = self.t - (self.dt if self.last is not None else 0.0)
+        self.t += n * self.dt
+        self.last = block[-1]
+        if len(traj) < 2:
+            return None
+
+        # Fixed point: all the derivatives below ftol during a whole window
+        speed = np.max(np.abs(np.diff(traj, axis=0)), axis=1) / self.dt
+        ftol = np.maximum(self.ftol, self.qtol * (1.0 + np.max(np.abs(traj[1:]), axis=1)))
+        fast = np.flatnonzero(speed >= ftol)
+        self.quiet = self.quiet + len(speed) if len(fast) == 0 else len(speed) - fast[-1] - 1
+        if self.quiet >= self.window:
+            fp = fixed_point(p, block[-1])
+            x, label = (fp['x'], fp['stability']) if fp else (block[-1], 'unknown')
+            self.reported = True
+            return {'type': 'fixed point', 'x': x, 'stability': label, 't': self.t}
+
+        # Limit cycle: returns to the Poincare section
+        self.recent = np.concatenate((self.recent, block[:, 0]))[-self.window:]
+        rmin, rmax = np.min(self.recent), np.max(self.recent)
+        if rmax - rmin < self.amin:
+            return None
+        level = 0.5 * (rmin + rmax)
+        re = traj[:, 0]
+        up = np.flatnonzero((re[:-1] < level) & (re[1:] >= level))
+        if len(up):
+            frac = ((level - re[up]) / (re[up + 1] - re[up]))[:, np.newaxis]
+            states = traj[up] + frac * (traj[up + 1] - traj[up])
+            times = t0 + (up + frac[:, 0]) * self.dt
+            self.crossings.extend(zip(times, states))
+            self.crossings = self.crossings[-(self.ncycles + 1):]
+        if len(self.crossings) <= self.ncycles:
+            return None
+        times = np.array([c[0] for c in self.crossings])
+        states = np.array([c[1] for c in self.crossings])
+        periods = np.diff(times)
+        period = np.mean(periods)
+        scale = np.max(np.abs(states), axis=0) + 1e-12
+        if (np.max(np.abs(periods - period)) < self.ptol * period
+                and np.max(np.abs(states - states[-1]) / scale) < self.stol):
+            self.reported = True
+            return {'type': 'limit cycle', 'period': period, 'amplitude': rmax - rmin, 'x': states[-1], 't': self.t}
+        return None
@@ -48,11 +48,15 @@ except ValueError:
 except AttributeError:
     logging.exception("pygobject version too old.")
 try:
-    from gi.repository import Gtk, GObject
+    from gi.repository import Gtk, Gdk, GObject
 except (ImportError, RuntimeError):
     logging.exception("Requires pygobject to be installed.")
 
 import numpy as np
+from timeit import default_timer as timer
+from simu_shm import SharedVars, SharedParams, Control, Counters
+from simu_io import checkpoint, save_checkpoint
+from sconf import now
 import matplotlib
 
 matplotlib.use("Gtk3Agg")
@@ -91,6 +95,7 @@ class MainGui:
         signals = {"gtk_main_quit": Gtk.main_quit,
                    "on_Update_clicked": self.dummy,
                    "on_Pause_clicked": self._on_pause_clicked,
+                   "on_Step_clicked": self._on_step_clicked,
                    "on_Stop_clicked": self._on_stop_clicked,
                    "on_Quit_clicked": self._on_exit_clicked,
                    "on_entry_activate": self._on_value_changed,
@@ -98,7 +103,7 @@ class MainGui:
                    "on_add_clicked": self._on_add_clicked,
                    "on_value_changed": self._on_value_changed,
                    "on_menu_new_activate": self.newsimulation,
-                   "on_menu_save_activate": self.dummy,
+                   "on_menu_save_activate": self.savecheckpoint,
                    "on_menu_open_activate": self.dummy,
                    "on_menu_quit_activate": self._on_exit_clicked,
                    "on_menu_newplot_activate": self.newplot,
@@ -114,18 +119,53 @@ class MainGui:
         store = self.update_tag_list(self.elements)  # Create the store
         self.update_combobox(combo, store)  # Update the combobox
 
-        # Prepare multiprocessing framework, we need an input queue and an output queue
-        self.q_in = multiprocessing.Queue()
+        # Prepare multiprocessing framework, we need a control channel and an output queue
+        self.ctrl = Control(paused=self.data.controls['pause'])
         self.q_out = multiprocessing.Queue()
-        self.multi_var = {}  # An additional object of shared memory, for plotting, saving, etc.
-        for var in self.data.vars.keys():
-            if isinstance(self.data.vars[var], type(np.array([0]))):
-                self.multi_var[var] = multiprocessing.Array('f', self.data.vars[var])
-            elif isinstance(self.data.vars[var], int):
-                self.multi_var[var] = multiprocessing.Value('i', self.data.vars[var])
+        self.stepsize = 1000  # Steps advanced by the Step button
+        # An additional object of shared memory, for plotting, saving, etc.
+        self.multi_var = SharedVars(self.data.vars, self.data.dtype, directory=self.data.mmap)
+        # Parameters are passed to the simulation through a shared block (see SharedParams)
+        self.multi_prm = SharedParams(self.data.prmts)
 
         self.simu_thread = None
         self.graphs = []
+        # Performance counters, sampled every second, shown in the status bar and saved in log/
+        self.counters = Counters()
+        self.statusbar = self.builder.get_object("statusbar")
+        self._sample = self.counters.sample()
+        self._counters_file = 'log/counters.csv'
+        GObject.timeout_add(1000, self._on_sample_counters)
+        # One timer refreshes all the plot windows
+        self.scheduler = RefreshScheduler(self.multi_var, self.graphs, counters=self.counters)
+
+    def _on_sample_counters(self):
+        """ Shows the performance counters of the last second and appends them to log/counters.csv."""
+        sample = self.counters.sample()
+        rates = Counters.rates(sample, self._sample)
+        self._sample = sample
+
+        def ms(value):
+            return '-' if value is None else '%.2f ms' % (1e3 * value)
+        text = ("%.3g steps/s (compute %.0f%%, control %.1f%%) | Control per block: %s | Parameter latency: %s"
+                " | Command latency: %s | Frame: %s | Snapshot: %s"
+                % (rates['steps/s'], 100 * rates['compute'], 100 * rates['control'], ms(rates['control/block']),
+                   ms(rates['param_latency']), ms(self.ctrl.latency), ms(rates['frame_time']),
+                   ms(rates['snapshot_time'])))
+        self.statusbar.push(1, text)
+        if rates['steps/s'] or rates['frame_time'] is not None:
+            columns = ('steps/s', 'compute', 'control', 'control/block', 'param_latency', 'frame_time',
+                       'snapshot_time')
+            new = not os.path.exists(self._counters_file)
+            try:
+                with open(self._counters_file, 'a') as f:
+                    if new:
+                        f.write('time,%s,command_latency\n' % ','.join(columns))
+                    f.write('%.3f,%s,%g\n' % (sample['time'], ','.join(['' if rates[c] is None else '%g' % rates[c]
+                                                                        for c in columns]), self.ctrl.latency))
+            except IOError:
+                self.logger.debug("Counters could not be saved in %s." % self._counters_file)
+        return True
 
     def _explore_tree(self, widget):
         """ Function to completely explore the widgets of the GUI"""
@@ -184,11 +224,10 @@ class MainGui:
     def _on_exit_clicked(self, event):
         """ Event function to quit the programm, it should take care of every opened process."""
         self.logger.debug('Button %s pressed' % event)
-        self._on_stop_clicked(None)
-        time.sleep(0.1)
-        self.q_in.close()
+        self.ctrl.exit()
         self.q_out.close()
         if self.simu_thread:
+            self.simu_thread.join(1.0)
             if self.simu_thread.is_alive():
                 self.simu_thread.terminate()
                 self.logger.debug('Thread terminated.')
@@ -200,12 +239,22 @@ class MainGui:
 
     def _on_pause_clicked(self, event):
         self.logger.debug('Button %s pressed' % event)
-        self.data.controls['pause'] = not self.data.controls['pause']
-        self.q_in.put({'pause': self.data.controls['pause']})
+        # The simulation may have paused itself (see AttractorDetector), the control channel has the actual state
+        self.data.controls['pause'] = self.ctrl.command != Control.PAUSE
+        if self.data.controls['pause']:
+            self.ctrl.pause()
+        else:
+            self.ctrl.resume()
+
+    def _on_step_clicked(self, event):
+        """ Advances exactly self.stepsize steps and leaves the simulation paused."""
+        self.logger.debug('Button %s pressed' % event)
+        self.data.controls['pause'] = True
+        self.ctrl.advance(self.stepsize)
 
     def _on_stop_clicked(self, event):
         self.logger.debug('Button %s pressed' % event)
-        self.q_in.put({'stop': True})
+        self.ctrl.stop()
 
     def _on_combo_changed(self, combo):
         """ Changing the combobox will change the value of the entry at the right side of the combo box.
@@ -245,11 +294,10 @@ class MainGui:
         value = entry.get_text()
         if tipo != str:
             self.data.prmts[element] = tipo(value.replace(',', '.'))
+            self.multi_prm[element] = self.data.prmts[element]
         else:
             self.data.prmts[element] = value
 
-        self.q_in.put({element: value})
-
     def _on_value_changed(self, spinbox):
         self.logger.debug('Element on %s modified' % spinbox.get_name())
         # We must know the value in the combobox next to the entry
@@ -264,7 +312,7 @@ class MainGui:
         if element:
             self.data.prmts[element] = value
             self.logger.debug("Element %s changed to %s" % (element, str(value)))
-            self.q_in.put({element: value})
+            self.multi_prm[element] = value
 
     def _on_add_clicked(self, button):
         """ Add a new row to be able to modify another parameter"""
@@ -317,7 +365,7 @@ class MainGui:
         if dialog.accept:
             title = dialog.plt_vars['y'] + ' vs. ' + dialog.plt_vars['x']
             graph = Graph(self.multi_var, title=title, pvars=(dialog.plt_vars['x'], dialog.plt_vars['y']),
-                          store=dialog.store, lims=self.data.lims)
+                          store=dialog.store, lims=self.data.lims, scheduler=self.scheduler)
             graph.nsteps = self.data.nsteps
             graph.ax.set_xlim(dialog.lim['x'])
             graph.ax.set_ylim(dialog.lim['y'])
@@ -329,15 +377,58 @@ class MainGui:
         """ Function to send a job to the child process. TO BE FIXED Stout problem."""
         self.logger.debug('Element on %s modified' % menu.get_name())
         self.data.controls.update({'stop': False, 'pause': True, 'exit': False})
+        self.ctrl.reset(paused=True)
         if self.simu_thread:
             if self.simu_thread.is_alive():
                 self.simu_thread.terminate()
                 del self.simu_thread
 
         self.simu_thread = multiprocessing.Process(None, self.sfunc,
-                                                   args=(self.data, self.multi_var, self.q_in, self.q_out))
+                                                   args=(self.data, self.multi_var, self.ctrl, self.multi_prm,
+                                                         self.q_out),
+                                                   kwargs={'counters': self.counters})
         self.simu_thread.start()
 
+    def savecheckpoint(self, menu):
+        """ Saves a checkpoint of the running simulation from the shared memory (see --external).
+            Only a copy taken while no block is being written (no pending slots) and with the same
+            sequence before and after is saved. When the simulation keeps publishing blocks faster
+            than the copy, it is paused for the copy and resumed afterwards.
+        """
+        keys = sorted([key for key in self.multi_var.keys() if key != 't'])
+        prmts = dict(self.data.prmts)
+        self.multi_prm.update(prmts)
+        state, tstep = self._consistent_copy(keys, prmts)
+        if state is None and self.ctrl.command == Control.RUN:
+            self.ctrl.pause()
+            time1 = time.time()
+            while self.ctrl.pending and time.time() - time1 < 5.0:
+                time.sleep(0.001)
+            state, tstep = self._consistent_copy(keys, prmts)
+            self.ctrl.resume()
+        if state is None:
+            self.logger.warning("No consistent copy of the buffers, the checkpoint is not saved.")
+            self.statusbar.push(2, "Checkpoint not saved: the simulation is writing the buffers.")
+            return
+        filename = 'results/checkpoint_%s_%s.npz' % now('-', '-')
+        save_checkpoint(filename, state)
+        self.statusbar.push(2, "Checkpoint at t = %g saved to %s." % (self.data.elapsed + tstep * self.data.dt,
+                                                                      filename))
+
+    def _consistent_copy(self, keys, prmts, attempts=5):
+        """ Checkpoint of the shared buffers, retried while a block is written during the copy.
+        :return: (state, tstep), state is None if no attempt gave a consistent copy.
+        """
+        for attempt in xrange(attempts):
+            seq, tstep, pending = self.multi_var.snapshot()
+            if pending:
+                time.sleep(0.001)
+                continue
+            state = checkpoint(self.multi_var, keys, tstep, prmts, self.data.dt, self.data.elapsed)
+            if self.multi_var.sequence == seq:
+                return state, tstep
+        return None, None
+
     @staticmethod
     def update_combobox(combo, elements):
         combo.set_model(elements)
@@ -475,12 +566,74 @@ class PlotDialog(Gtk.Dialog):
         self.accept = False
 
 
+class RefreshScheduler:
+    """ Single timer that draws the frames of all the Graph windows. Every tick takes one snapshot
+        of the shared variables, passes it to the windows that are plotting, shown and have new
+        data, and blits them. The interval between ticks follows the measured time of the tick,
+        so that at most ``load`` of the time of the GUI process is spent drawing.
+    """
+
+    def __init__(self, data, graphs, load=0.25, min_interval=20, max_interval=1000, counters=None):
+        self.logger = logging.getLogger('gui.RefreshScheduler')
+        self.data = data
+        self.graphs = graphs
+        self.counters = counters
+        self.load, self.min_interval, self.max_interval = load, min_interval, max_interval
+        self.interval = 42
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            GObject.timeout_add(self.interval, self.tick)
+
+    def render(self, graphs, force=False):
+        """ Updates and blits ``graphs`` from one consistent snapshot (read again if the simulation
+            published a new block in the meantime).
+        :return: the graphs that were drawn.
+        """
+        time1 = timer()
+        for attempt in xrange(3):
+            time2 = timer()
+            snapshot = self.data.snapshot()
+            if self.counters is not None:
+                self.counters.add('snapshots')
+                self.counters.add('snapshot_time', timer() - time2)
+            changed = [graph for graph in graphs if graph._plotpoints(snapshot, force=force)]
+            if self.data.sequence == snapshot[0]:
+                break
+            force = True
+        elapsed = (timer() - time1) / max(len(changed), 1)
+        for graph in changed:
+            time2 = timer()
+            graph._blit()
+            graph.frame(elapsed + timer() - time2)
+            if self.counters is not None:
+                self.counters.add('frames')
+                self.counters.add('frame_time', elapsed + timer() - time2)
+        return changed
+
+    def tick(self):
+        active = [graph for graph in self.graphs if graph.PLOT]
+        if not active:
+            self.running = False
+            return False
+        time1 = timer()
+        self.render([graph for graph in active if graph.shown])
+        elapsed = timer() - time1
+        self.interval = int(min(max(1e3 * elapsed / self.load, self.min_interval), self.max_interval))
+        GObject.timeout_add(self.interval, self.tick)
+        return False
+
+
 class Graph(Gtk.Window):
     """ Gtk object containing a canvas plus some other widget, such as a toolbox."""
 
-    def __init__(self, data, title='Matplotlib', size=(800, 500), pvars=('t', 're'), store=None, lims=None):
+    def __init__(self, data, title='Matplotlib', size=(800, 500), pvars=('t', 're'), store=None, lims=None,
+                 scheduler=None):
         """ Initialization requires a memory shared data object (dictionary). And some key values
-            representing the variables to be plotted.
+            representing the variables to be plotted. Frames are drawn by ``scheduler`` (a
+            RefreshScheduler shared by all the windows), by default the window has its own one.
         """
         Gtk.Window.__init__(self, title=title)
         self.logger = logging.getLogger('gui.Graph')
@@ -494,6 +647,9 @@ class Graph(Gtk.Window):
         self.set_default_size(*size)
         self.boxvertical = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.connect("delete-event", self._destroy)
+        self.connect("window-state-event", self._on_window_state)
+        self.iconified = False
+        self.scheduler = scheduler or RefreshScheduler(data, [self])
         self.add(self.boxvertical)
 
         self.toolbar = Gtk.Toolbar()
@@ -527,12 +683,15 @@ class Graph(Gtk.Window):
         self.boxvertical.pack_start(self.statbar, False, True, 0)
 
         self.fig.canvas.mpl_connect('motion_notify_event', self._updatecursorposition)
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self._zooming = False
+        self.ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
 
         # Figure plotting variables
         self.xdata = np.linspace(0, 2.0, 10)
         self.ydata = self.xdata * 0.0
         self.plots = []
-        self.p1, = self.ax.plot(self.xdata, self.ydata, animated=False)
+        self.p1, = self.ax.plot(self.xdata, self.ydata, animated=True)
         self.plots.append(self.p1)
         self.ax.grid(True)
         self.ax.set_xlabel(pvars[0], fontsize='20')
@@ -541,6 +700,11 @@ class Graph(Gtk.Window):
         self.bg = self.fig.canvas.copy_from_bbox(self.ax.bbox)
         self.PLOT = False
 
+        # Rendering: the lines are animated artists blitted over the cached background (self.bg)
+        self._last = None  # tstep of the last frame
+        self._phase = {}  # Copies of the samples of the phase plots, updated in place
+        self._frames, self._fps_time, self._draw_time = 0, timer(), 0.0
+
     def _resetplot(self):
         # self.ax.cla()
         # self.ax.set_xlim(0, 10)
@@ -550,37 +714,99 @@ class Graph(Gtk.Window):
     def _destroy(self, *args):
         self.PLOT = False
 
-    def run_dynamically(self, event):
-        self.PLOT = not self.PLOT
-        GObject.timeout_add(42, self.plot)
+    def _on_window_state(self, widget, event):
+        self.iconified = bool(event.new_window_state & Gdk.WindowState.ICONIFIED)
 
-    def plot(self):
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-        self._plotpoints()
-        return self.PLOT
+    @property
+    def shown(self):
+        """ False if the window is hidden or iconified (no frames are drawn)."""
+        return self.get_mapped() and not self.iconified
 
-    def _plotpoints(self):
-        """ It changes the data of both axis taking the information from the shared memory object."""
+    def run_dynamically(self, event):
+        self.PLOT = not self.PLOT
+        if self.PLOT:
+            self.scheduler.start()
+
+    def frame(self, elapsed):
+        """ Counts a frame drawn in ``elapsed`` seconds and shows the frame rate once per second."""
+        self._frames += 1
+        self._draw_time += elapsed
+        now = timer()
+        if now - self._fps_time >= 1.0:
+            fps = self._frames / (now - self._fps_time)
+            draw = 1e3 * self._draw_time / self._frames
+            self.statbar.push(2, "%.1f FPS (%.1f ms per frame)" % (fps, draw))
+            self._frames, self._fps_time, self._draw_time = 0, now, 0.0
+
+    def _blit(self):
+        """ Draws the lines over the cached background and copies only the axes to the screen."""
+        self.canvas.restore_region(self.bg)
+        for p in self.plots:
+            self.ax.draw_artist(p)
+        self.canvas.blit(self.ax.bbox)
+
+    def _on_draw(self, event):
+        """ After a full redraw (resize, zoom, ...) the background is captured again, without the lines."""
+        self.bg = self.canvas.copy_from_bbox(self.ax.bbox)
+        for p in self.plots:
+            self.ax.draw_artist(p)
+
+    def _plotpoints(self, snapshot, stride=50, force=False):
+        """ It changes the data of both axis taking the information from the shared memory object.
+            Time series are drawn as the min/max envelope of the visible interval with one point per
+            pixel (see simu_shm.MinMaxPyramid), so the cost does not depend on the length of the
+            history and peaks are not aliased away. Phase plots take one of every ``stride`` samples
+            and only the samples written since the last frame are copied.
+        :param snapshot: (sequence, tstep, pending) of the shared variables (see SharedVars.snapshot).
+        :return: False if nothing changed since the last frame.
+        """
+        seq, tstep, pending = snapshot
+        if tstep == self._last and not force:
+            return False
+        t = self.data['t']
+        t0, dt = t[0], t[1] - t[0]
+        xmin, xmax = self.ax.get_xlim()
+        npixels = max(int(self.ax.bbox.width), 1)
         for p, var in zip(self.plots, self.vars):
-            tstep = self.data['tstep'].value % self.nsteps
-            if var[0] == 't' and tstep != 0:
-                ydata1 = self.data[var[1]][tstep:]
-                ydata2 = self.data[var[1]][0:tstep]
-                ydata = np.concatenate((ydata1, ydata2))
+            if var[0] == 't':
+                i0 = max(int((xmin - t0) / dt), pending)
+                i1 = int(np.ceil((xmax - t0) / dt)) + 1
+                positions, ymin, ymax = self.data.envelope(var[1], tstep, i0, i1, npixels)
+                p.set_xdata(np.repeat(t[positions], 2))
+                p.set_ydata(np.column_stack((ymin, ymax)).ravel())
             else:
-                ydata = self.data[var[1]][::]
-
-            p.set_xdata(self.data[var[0]][::50])
-            p.set_ydata(ydata[::50])
-        # self.ax.set_ylim([np.min(ydata), np.max(ydata)])
-        # self.ax.set_xlim([0, 2.0])
-        # self.ax.set_ylim([0, 2.0])
-        # self.fig.canvas.restore_region(self.bg)
-        # self.resetplot()
-        # self.ax.draw_artist(self.p1)
-        # self.fig.canvas.blit(self.ax.bbox)
-        self.canvas.draw()
+                self._update_phase(p, tuple(var), tstep, stride)
+        self._last = tstep
+        return True
+
+    def _update_phase(self, line, var, tstep, stride):
+        """ Copies into the line data of a phase plot the samples written since the last frame."""
+        nsteps = len(self.data['t'])
+        new = tstep - self._last if self._last is not None and tstep > self._last else nsteps
+        if var not in self._phase or new >= nsteps:
+            self._phase[var] = (self.data[var[0]][::stride].copy(), self.data[var[1]][::stride].copy())
+            line.set_data(*self._phase[var])
+            return
+        x, y = self._phase[var]
+        start = self._last % nsteps
+        segments = [(start, min(start + new, nsteps))]
+        if start + new > nsteps:
+            segments.append((0, start + new - nsteps))
+        for a, b in segments:
+            ja, jb = (a + stride - 1) // stride, (b + stride - 1) // stride
+            x[ja:jb] = self.data[var[0]][ja * stride:b:stride]
+            y[ja:jb] = self.data[var[1]][ja * stride:b:stride]
+
+    def _refresh(self):
+        self.scheduler.render([self], force=True)
+        self._zooming = False
+        return False
+
+    def _on_xlim_changed(self, ax):
+        """ Zoom or pan with the toolbar: the envelope of the new interval is read once the event is processed."""
+        if not self._zooming:
+            self._zooming = True
+            GObject.idle_add(self._refresh)
 
     def _updatecursorposition(self, event):
         """When cursor inside plot, get position and print to status-bar"""
@@ -595,9 +821,10 @@ class Graph(Gtk.Window):
         response = dialog.run()
 
         if response == Gtk.ResponseType.OK:
-            p, = self.ax.plot(self.xdata, self.ydata, animated=False)
+            p, = self.ax.plot(self.xdata, self.ydata, animated=True)
             self.plots.append(p)
             self.vars.append([self.vars[0][0], dialog.choice])
+            self._refresh()
         elif response == Gtk.ResponseType.CANCEL:
             pass
 
@@ -0,0 +1,179 @@
+import os
+import json
+import threading
+import Queue
+import numpy as np
+import logging
+from timeit import default_timer as timer
+
+logging.getLogger('simu_io').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Saving and loading simulation data.
+
+    HistoryWriter: (background thread that appends every computed block to a chunked binary file)
+    **************
+    load_history: (reads back a file written by HistoryWriter)
+    *************
+    checkpoint: (copy of the state of a simulation: ring buffers, steps, parameters and time)
+    ***********
+    save_checkpoint: (writes a checkpoint as a binary .npz file, in a background thread)
+    ****************
+    load_checkpoint: (reads a checkpoint, see Data.restore and --external)
+    ****************
+"""
+
+
+class HistoryWriter(threading.Thread):
+    """ Drains the blocks computed by the simulation into an append-only file, in a background
+        thread. The file is a sequence of .npy records: a header with the column names and then
+        one (m, 1 + nvars) record per block with the time and the (decimated) variables.
+        push() only copies the block and queues it without waiting: if the queue is full the
+        block is dropped and counted, the integration loop is never blocked.
+    """
+
+    def __init__(self, filename, names, dt, t0=0.0, decimate=1, maxqueue=64):
+        threading.Thread.__init__(self, name='HistoryWriter')
+        self.daemon = True
+        self.logger = logging.getLogger('simu_io.HistoryWriter')
+        self.filename = filename
+        self.names = list(names)
+        self.dt, self.t0 = dt, t0
+        self.decimate = max(int(decimate), 1)
+        self.queue = Queue.Queue(maxqueue)
+        self.stats = {'blocks': 0, 'dropped': 0, 'bytes': 0, 'write_time': 0.0, 'max_depth': 0}
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(filename, 'wb')
+        np.save(self._file, np.array(['t'] + self.names))
+        self.start()
+        self.logger.debug("Saving %s to %s (one of every %d steps)." % (', '.join(self.names), filename, decimate))
+
+    def push(self, var, k, n, tstep):
+        """ Queues the ``n`` samples written after index ``k`` of the ring buffers ``var``.
+        :param tstep: number of steps computed before the block.
+        """
+        nsteps = len(var[self.names[0]])
+        # Steps of the block that are kept, counted from 1 (the initial condition is step 0)
+        steps = np.arange(tstep + 1, tstep + n + 1)
+        steps = steps[steps % self.decimate == 0]
+        if len(steps) == 0:
+            return
+        index = (k + steps - tstep) % nsteps
+        record = np.empty((len(steps), 1 + len(self.names)))
+        record[:, 0] = self.t0 + steps * self.dt
+        for col, key in enumerate(self.names):
+            record[:, col + 1] = var[key][index]
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.stats['dropped'] += 1
+            if self.stats['dropped'] == 1:
+                self.logger.warning("Writer queue full, blocks are being dropped.")
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            time1 = timer()
+            np.save(self._file, record)
+            self._file.flush()
+            self.stats['write_time'] += timer() - time1
+            self.stats['bytes'] += record.nbytes
+            self.stats['blocks'] += 1
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    @property
+    def throughput(self):
+        """ Write throughput (bytes/s) of the time spent writing."""
+        return self.stats['bytes'] / self.stats['write_time'] if self.stats['write_time'] else 0.0
+
+    def close(self):
+        """ Writes the pending blocks and closes the file."""
+        self.queue.put(None)
+        self.join()
+        self._file.close()
+        self.logger.info("%d blocks (%.1f MB) saved to %s at %.1f MB/s. Max. queue depth %d, %d blocks dropped."
+                         % (self.stats['blocks'], self.stats['bytes'] / 1e6, self.filename, self.throughput / 1e6,
+                            self.stats['max_depth'], self.stats['dropped']))
+        return self.stats
+
+
+def load_history(filename):
+    """ Reads a file written by HistoryWriter.
+    :return: dictionary name -> array, including the time 't'.
+    """
+    records = []
+    with open(filename, 'rb') as f:
+        names = list(np.load(f))
+        size = os.path.getsize(filename)
+        while f.tell() < size:
+            try:
+                records.append(np.load(f))
+            except (IOError, ValueError):
+                break
+    table = np.concatenate(records) if records else np.empty((0, len(names)))
+    return dict([(name, table[:, col]) for col, name in enumerate(names)])
+
+
+def checkpoint(var, keys, tstep, prmts, dt, elapsed):
+    """ Copies the state of a running simulation. The ring buffers are stored in order, from the
+        oldest to the newest sample (the current state is the last sample).
+    :param var: ring buffers (dictionary or SharedVars).
+    :param keys: names of the buffers to store.
+    :param tstep: steps computed in this run.
+    :param prmts: dictionary of parameters.
+    :param elapsed: time integrated before this run (Data.elapsed).
+    :return: dictionary name -> array, with the metadata under '_meta'.
+    """
+    nsteps = len(var[keys[0]])
+    start = tstep % nsteps
+    state = dict([(key, np.concatenate((var[key][start:], var[key][:start]))) for key in keys])
+    meta = {'tstep': tstep, 'dt': dt, 'nsteps': nsteps, 'time': elapsed + tstep * dt,
+            'prmts': dict([(key, value) for key, value in prmts.items() if isinstance(value, (int, float, str))])}
+    state['_meta'] = np.array(json.dumps(meta))
+    return state
+
+
+def save_checkpoint(filename, state, wait=False):
+    """ Writes a checkpoint (see checkpoint) as an uncompressed .npz file. The file is written in a
+        background thread under a temporary name and renamed when complete, so a checkpoint file
+        is never partial.
+    :return: the writing thread.
+    """
+    logger = logging.getLogger('simu_io.save_checkpoint')
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    def write():
+        time1 = timer()
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, **state)
+        os.rename(filename + '.tmp', filename)
+        size = sum([value.nbytes for value in state.values()])
+        logger.info("Checkpoint at t = %g saved to %s (%.1f MB in %.2f s)."
+                    % (json.loads(str(state['_meta']))['time'], filename, size / 1e6, timer() - time1))
+    thread = threading.Thread(target=write, name='Checkpoint')
+    thread.start()
+    if wait:
+        thread.join()
+    return thread
+
+
+def load_checkpoint(filename):
+    """ Reads a checkpoint written by save_checkpoint.
+    :return: (arrays, meta), the ordered ring buffers and a dictionary with 'tstep', 'dt', 'nsteps',
+             'time' and 'prmts'.
+    """
+    with np.load(filename) as f:
+        arrays = dict([(key, f[key]) for key in f.files if key != '_meta'])
+        meta = json.loads(str(f['_meta']))
+    return arrays, meta
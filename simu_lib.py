@@ -1,5 +1,7 @@
 import numpy as np
+import math
 import logging
+import tempfile
 
 logging.getLogger('simu_lib').addHandler(logging.NullHandler())
 
@@ -9,8 +11,24 @@ __author__ = 'Jose M. Esnaola Acebes'
 
     Data: (to store parameters, variables, and some functions)
     *****
+    ring_buffer: (buffer of a variable, in memory or in a memory-mapped file)
+    ************
+    write_block: (writes a computed block after an index of the ring buffers, wrapping around the end)
+    ************
+    fr_block: (firing-rate integration kernel, advances the E/I equations K steps at once)
+    *********
+    fr_field: (vector field of the E/I equations, for other integrators and analysis tools)
+    *********
+    Simulator: (embeddable simulation built around Data: run, set_params, state and a stream of blocks)
+    **********
 """
 
+pi = np.pi
+pi2 = np.pi * np.pi
+
+# Order of the firing-rate variables in the ring buffers
+FR_VARS = ('re', 've', 'se', 'ri', 'vi', 'si')
+
 
 class Data:
     """ The data structure will have a general structure but must be shaped to match the simulation
@@ -27,14 +45,38 @@ class Data:
         self.tfinal = parameters['tfinal']  # Final time
         self.total_time = parameters['tfinal'] - parameters['t0']  # Time of simulation
         self.dt = parameters['dt']  # Time step
+        self.dtype = np.dtype(parameters.get('prec', 'float64'))  # Precision of the stored variables
+        self.integrator = parameters.get('int', 'euler')  # Integrator of the firing-rate equations
+        self.tol = parameters.get('tol', 1e-6)  # Relative tolerance of the adaptive integrator
+        self.autostop = parameters.get('auto', 'none')  # Action when a fixed point or a limit cycle is reached
+        # Save the history of the variables (see simu_io.HistoryWriter): by default in headless runs, with the GUI
+        # only when an output file is given
+        self.save = not parameters.get('nos', True) and (parameters.get('hl', False) or bool(parameters.get('out', '')))
+        self.minimal = parameters.get('pl', False)  # Save only the firing rates
+        self.decimate = parameters.get('dec', 1)  # Save one of every 'decimate' steps
+        self.output = parameters.get('out', '')  # File where the history is saved
+        self.mmap = parameters.get('mm', '') or None  # Directory of the memory-mapped buffers (None: in memory)
+        self.freq = parameters.get('Frq', False)  # Online frequency analysis (see simu_spec.WelchPSD)
+        self.fwindow = parameters.get('win', 20.0)  # Length (time units) of the segments of the analysis
+        self.external = parameters.get('ext', '')  # Checkpoint where the simulation starts (see simu_io)
+        self.override = parameters.get('oic', False)  # Take only the state of the checkpoint, not its parameters
+        self.checkpoint = parameters.get('ckp', 0.0)  # Time between checkpoints (0: none)
+        self.elapsed = 0.0  # Time integrated before this run (by the run that wrote the checkpoint)
 
         # 0.2) Define the temporal resolution and other time-related variables
-        self.tpoints = np.arange(self.t0, self.tfinal, self.dt)  # Points for the plots and others
-        self.nsteps = len(self.tpoints)  # Total time steps
+        self.nsteps = int(np.ceil((self.tfinal - self.t0) / self.dt))  # Total time steps
+        self.tpoints = ring_buffer(self.nsteps, directory=self.mmap, name='t')  # Points for the plots and others
+        for i in xrange(0, self.nsteps, 1 << 22):
+            n = min(1 << 22, self.nsteps - i)
+            self.tpoints[i:i + n] = self.t0 + self.dt * np.arange(i, i + n)
         # self.taum = self.tau_mi / self.tau_me
         # self.taue = self.tau_de * np.sqrt(self.eta) / self.tau_me
         # self.taui = self.tau_di * np.sqrt(self.eta) / self.tau_me
 
+        self.N = parameters.get('N', 10000)  # Neurons per population (QIF network)
+        self.K = parameters.get('K', 0)  # In-degree of the QIF network (0: all to all)
+        self.workers = parameters.get('nw', 1)  # Processes integrating the (all to all) QIF network
+
         self.sys = parameters['system']
         self.systems = []
         if self.sys in ('qif', 'both'):
@@ -50,22 +92,328 @@ class Data:
                      've': [-2, 2], 'vi': [-2, 2], 'se': [0, 2], 'si': [0, 2]}
         # Output variables will be stored in dictionaries to make the Queue handling easy
         if self.sys != 'qif':
-            self.exc = self.population(self.nsteps, 2.0, -1.0, 0.0, name="e")
-            self.inh = self.population(self.nsteps, 1.0, -0.5, 0.0, name="i")
+            self.exc = self.population(self.nsteps, 2.0, -1.0, 0.0, name="e", dtype=self.dtype, directory=self.mmap)
+            self.inh = self.population(self.nsteps, 1.0, -0.5, 0.0, name="i", dtype=self.dtype, directory=self.mmap)
             self.vars.update(self.exc)
             self.vars.update(self.inh)
+        if 'qif' in self.systems:
+            self.qexc = self.population(self.nsteps, 2.0, -1.0, 0.0, name="qe", dtype=self.dtype, directory=self.mmap)
+            self.qinh = self.population(self.nsteps, 1.0, -0.5, 0.0, name="qi", dtype=self.dtype, directory=self.mmap)
+            self.vars.update(self.qexc)
+            self.vars.update(self.qinh)
+            self.lims.update({'rqe': [0, 1], 'rqi': [0, 1], 'vqe': [-2, 2], 'vqi': [-2, 2],
+                              'sqe': [0, 2], 'sqi': [0, 2]})
+        if self.freq and 'fr' in self.systems:
+            # Dominant frequency of re, ri, se and si (simu_spec.FREQ_VARS) at every step
+            for key in ('re', 'ri', 'se', 'si'):
+                self.vars['f' + key] = ring_buffer(self.nsteps, 0.0, self.dtype, self.mmap, 'f' + key)
+                self.lims['f' + key] = [0, 2]
+        if self.external:
+            from simu_io import load_checkpoint
+            self.restore(*load_checkpoint(self.external))
+        if self.mmap:
+            size = sum([value.nbytes for value in self.vars.values() if isinstance(value, np.ndarray)])
+            self.logger.info("%.1f MB of buffers mapped in %s." % (size / 1e6, self.mmap))
+
+    def restore(self, arrays, meta):
+        """ Starts from a checkpoint (see simu_io.checkpoint): its last samples are copied to the end
+            of the ring buffers, where the initial conditions are taken from, and its parameters
+            replace the configured ones (unless ``override``).
+        """
+        if meta['nsteps'] != self.nsteps:
+            self.logger.warning("The checkpoint has %d steps and the buffers %d: only the last %d are kept."
+                                % (meta['nsteps'], self.nsteps, min(meta['nsteps'], self.nsteps)))
+        rescale = abs(meta['dt'] - self.dt) > 1e-12 * self.dt
+        if rescale:
+            # The history is resampled (linear interpolation) on the time grid of dt, ending at the same state
+            self.logger.warning("The checkpoint was computed with dt = %g, its history is resampled with dt = %g."
+                                % (meta['dt'], self.dt))
+            told = -meta['dt'] * np.arange(meta['nsteps'] - 1, -1, -1)
+            tnew = -self.dt * np.arange(self.nsteps - 1, -1, -1)
+            tnew = tnew[tnew >= told[0]]
+        for key, values in arrays.items():
+            if key in self.vars and key != 't':
+                if rescale:
+                    values = np.interp(tnew, told, values)
+                n = min(len(values), self.nsteps)
+                self.vars[key][self.nsteps - n:] = values[len(values) - n:]
+        if not self.override:
+            self.prmts.update(dict([(key, value) for key, value in meta['prmts'].items() if key in self.prmts]))
+        self.elapsed = meta['time']
+        self.logger.info("Starting from the checkpoint %s at t = %g%s." % (self.external, self.elapsed,
+                         '' if self.override else ' (with its parameters)'))
 
     @staticmethod
-    def population(nsteps, r0=1.0, v0=-1.0, s0=0.0, name=""):
-        r = np.ones(nsteps) * 0.1
-        v = np.ones(nsteps) * (-0.01)
+    def population(nsteps, r0=1.0, v0=-1.0, s0=0.0, name="", dtype=np.float64, directory=None):
+        r = ring_buffer(nsteps, 0.1, dtype, directory, 'r' + name)
+        v = ring_buffer(nsteps, -0.01, dtype, directory, 'v' + name)
         r[len(r) - 1] = r0
         v[len(v) - 1] = -v0
-        s = np.ones(nsteps) * 0.1
+        s = ring_buffer(nsteps, 0.1, dtype, directory, 's' + name)
         s[len(s) - 1] = s0
         return {'r' + name: r, 'v' + name: v, 's' + name: s}
 
 
+def ring_buffer(nsteps, fill=0.0, dtype=np.float64, directory=None, name=''):
+    """ Buffer of ``nsteps`` values of a variable. With a ``directory`` it is a np.memmap on an
+        (already unlinked) temporary file of that directory: the mapping is shared with the
+        processes forked afterwards (see simu_shm.SharedVars) and the page cache decides which
+        part stays in RAM, so the buffer can be larger than the available memory.
+    :param fill: initial value of the elements.
+    :param name: prefix of the temporary file.
+    :return: numpy array or np.memmap.
+    """
+    if directory is None:
+        arr = np.zeros(nsteps, dtype=dtype)
+    else:
+        with tempfile.TemporaryFile(prefix='%s_' % name, dir=directory) as f:
+            arr = np.memmap(f, dtype=dtype, mode='w+', shape=(nsteps,))
+    if fill:
+        arr[:] = fill
+    return arr
+
+
+def write_block(var, keys, k, out):
+    """ Writes a computed block after index ``k`` of the ring buffers, with (at most) two slice
+        assignments per buffer since the block may wrap around the end.
+    :param var: ring buffers (dictionary, SharedVars or multiprocessing Arrays).
+    :param keys: names of the buffers, one per column of ``out``.
+    :param k: index of the last step before the block.
+    :param out: array (n, len(keys)) with the n new steps, n <= nsteps.
+    """
+    n = len(out)
+    nsteps = len(var[keys[0]])
+    k0 = (k + 1) % nsteps
+    first = min(n, nsteps - k0)
+    for col, key in enumerate(keys):
+        buf = var[key]
+        buf[k0:k0 + first] = out[:first, col]
+        if n > first:
+            buf[0:n - first] = out[first:, col]
+
+
+def fr_block(var, k, nblock, p, dt, nsteps):
+    """ Firing-rate integration kernel: advances the E/I equations ``nblock`` Euler steps starting
+        from the values stored at index ``k`` of the ring buffers in ``var``. Parameters are frozen
+        into locals for the whole block and the new values are written back with write_block, so
+        ``var`` may hold numpy arrays or multiprocessing Arrays.
+    :param var: dictionary with the ring buffers 're', 've', 'se', 'ri', 'vi', 'si'.
+    :param k: index of the last computed step.
+    :param nblock: number of steps to advance (must not exceed nsteps).
+    :param p: dictionary of parameters (see conf.txt).
+    :param dt: time step.
+    :param nsteps: length of the ring buffers.
+    :return: number of steps actually computed, smaller than nblock if the solution diverged.
+    """
+    taume, taumi = float(p['taume']), float(p['taumi'])
+    taude, taudi = float(p['taude']), float(p['taudi'])
+    delta, etae, etai = float(p['delta']), float(p['etae']), float(p['etai'])
+    jc, js = float(p['jc']), float(p['js'])
+
+    # Constant terms of the vector field
+    dte, dti, dtse, dtsi = dt / taume, dt / taumi, dt / taude, dt / taudi
+    ce = delta / pi / taume
+    ci = delta / taumi / pi
+    pe = pi2 * taume ** 2
+    pin = pi2 * taumi ** 2
+    jce, jci, jsi = taume * jc, taumi * jc, taumi * js
+
+    r_e, v_e, s_e, r_i, v_i, s_i = [float(var[key][k]) for key in FR_VARS]
+    out = [[0.0] * nblock for _ in FR_VARS]
+    ore, ove, ose, ori, ovi, osi = out
+
+    for n in xrange(nblock):
+        r_e, v_e, r_i, v_i = (r_e + dte * (ce + 2.0 * r_e * v_e),
+                              v_e + dte * (v_e * v_e + etae - pe * r_e * r_e - jce * s_i),
+                              r_i + dti * (ci + 2.0 * r_i * v_i),
+                              v_i + dti * (v_i * v_i + etai - pin * r_i * r_i + jci * s_e - jsi * s_i))
+        s_e += dtse * (r_e - s_e)
+        s_i += dtsi * (r_i - s_i)
+        ore[n] = r_e
+        ove[n] = v_e
+        ose[n] = s_e
+        ori[n] = r_i
+        ovi[n] = v_i
+        osi[n] = s_i
+    out = np.array(out)
+
+    # Divergence check, once per block: the block is truncated at the first non-finite value
+    done = nblock
+    if math.isinf(r_e + r_i) or math.isnan(r_e + r_i):
+        bad = np.flatnonzero(~np.isfinite(out[0] + out[3]))
+        done = int(bad[0])
+
+    write_block(var, FR_VARS, k, out[:, :done].T)
+    return done
+
+
+def fr_field(p):
+    """ Vector field of the E/I firing-rate equations (the same ones fr_block integrates).
+    :param p: dictionary of parameters (see conf.txt).
+    :return: function f(x) -> dx/dt, for states x = (re, ve, se, ri, vi, si).
+    """
+    taume, taumi = float(p['taume']), float(p['taumi'])
+    taude, taudi = float(p['taude']), float(p['taudi'])
+    delta, etae, etai = float(p['delta']), float(p['etae']), float(p['etai'])
+    jc, js = float(p['jc']), float(p['js'])
+    ce = delta / pi / taume
+    ci = delta / taumi / pi
+    pe = pi2 * taume ** 2
+    pin = pi2 * taumi ** 2
+    jce, jci, jsi = taume * jc, taumi * jc, taumi * js
+
+    def f(x):
+        r_e, v_e, s_e, r_i, v_i, s_i = x
+        return np.array([(ce + 2.0 * r_e * v_e) / taume,
+                         (v_e * v_e + etae - pe * r_e * r_e - jce * s_i) / taume,
+                         (r_e - s_e) / taude,
+                         (ci + 2.0 * r_i * v_i) / taumi,
+                         (v_i * v_i + etai - pin * r_i * r_i + jci * s_e - jsi * s_i) / taumi,
+                         (r_i - s_i) / taudi])
+    return f
+
+
+class Simulator:
+    """ Simulation of the systems configured in a Data object without GUI nor queues, to be driven
+        from scripts and analysis pipelines:
+
+            sim = Simulator(Data(opts))
+            sim.run(100000)
+            sim.set_params(etae=-2.0)
+            for block in sim.stream(5000):
+                analyse(block['t'], block['re'])
+
+        The variables are written to the ring buffers ``var`` (Data.vars by default, or e.g. a
+        simu_shm.SharedVars, whose blocks are then published). main.simulation drives one of these.
+    """
+
+    def __init__(self, data, var=None, blocksize=1000, seed=None):
+        # Imported here: these modules depend on simu_lib
+        from simu_ode import FrDopri
+        from simu_qif import QifNetwork, SparseQifNetwork, ShardedQifNetwork, QIF_VARS
+
+        self.logger = logging.getLogger('simu_lib.Simulator')
+        self.data = data
+        self.var = data.vars if var is None else var
+        self.p = data.prmts
+        self.dt = data.dt
+        self.nsteps = data.nsteps
+        self.blocksize = blocksize
+        self.tstep = 0  # Steps computed, the initial conditions are at the end of the buffers
+        self.diverged = False
+        self._shared = hasattr(self.var, 'publish')
+        self.keys = [key for key in FR_VARS + QIF_VARS if key in self.var]
+
+        k = self.nsteps - 1
+        if 'fr' in data.systems and data.integrator == 'dopri':
+            self.ode = FrDopri(self.p, [self.var[key][k] for key in FR_VARS], self.dt, rtol=data.tol,
+                               atol=data.tol * 1e-3)
+        else:
+            self.ode = None
+        x0 = [self.var[key][k] for key in QIF_VARS] if 'qif' in data.systems else None
+        if 'qif' in data.systems and data.K:
+            self.net = SparseQifNetwork(data.N, self.p, self.dt, data.K, x0=x0, seed=seed)
+        elif 'qif' in data.systems and data.workers > 1:
+            self.net = ShardedQifNetwork(data.N, self.p, self.dt, data.workers, x0=x0, seed=seed)
+        elif 'qif' in data.systems:
+            self.net = QifNetwork(data.N, self.p, self.dt, x0=x0, seed=seed)
+        else:
+            self.net = None
+
+    @property
+    def k(self):
+        """ Index of the last computed step in the ring buffers."""
+        return (self.tstep + self.nsteps - 1) % self.nsteps
+
+    @property
+    def t(self):
+        return self.data.t0 + self.tstep * self.dt
+
+    def set_params(self, **kwargs):
+        """ Changes parameters of the running simulation (without arguments, it takes the changes
+            already made in Data.prmts).
+        """
+        unknown = set(kwargs) - set(self.p)
+        if unknown:
+            raise KeyError('Unknown parameter(s): %s' % ', '.join(sorted(unknown)))
+        self.p.update(kwargs)
+        for engine in (self.ode, self.net):
+            if engine is not None:
+                engine.set_params(self.p)
+
+    def advance(self, nblock, hook=None):
+        """ Computes one block of at most ``nblock`` steps (and at most nsteps).
+        :param hook: function hook(var, k, done) called after the block is written and before it is
+                     published, to write derived buffers in the same block (e.g. the frequencies).
+        :return: (k, done), the index of the last step before the block and the number of steps
+                 computed, smaller than nblock if the solution diverged.
+        """
+        k = self.k
+        nblock = min(nblock, self.nsteps)
+        if self._shared:
+            self.var.begin(nblock)
+        done = nblock
+        if self.ode is not None:
+            done = self.ode.block(self.var, k, nblock, self.nsteps)
+        elif 'fr' in self.data.systems:
+            done = fr_block(self.var, k, nblock, self.p, self.dt, self.nsteps)
+        if self.net is not None:
+            self.net.block(self.var, k, done, self.nsteps)
+        if hook is not None and done:
+            hook(self.var, k, done)
+        self.tstep += done
+        if self._shared:
+            self.var.publish(self.tstep)
+        if done < nblock:
+            self.diverged = True
+            self.logger.error("Overflow encountered at t = %f! Change parameters before running a new instance "
+                              "of the simulation." % self.t)
+        return k, done
+
+    def run(self, n_steps):
+        """ Advances ``n_steps`` steps in blocks of ``blocksize``.
+        :return: number of steps computed (fewer if the solution diverged).
+        """
+        total = 0
+        while total < n_steps and not self.diverged:
+            k, done = self.advance(min(self.blocksize, n_steps - total))
+            total += done
+        return total
+
+    def state(self):
+        """ Current values of the variables, plus the time 't' and the number of steps 'tstep'."""
+        k = self.k
+        state = dict([(key, float(self.var[key][k])) for key in self.keys])
+        state.update({'t': self.t, 'tstep': self.tstep})
+        return state
+
+    def stream(self, chunk, n_steps=None):
+        """ Generator of the blocks computed from now on, ``chunk`` steps at most (blocks stop at the
+            end of the ring buffers so that they are contiguous). The blocks are views of the ring
+            buffers, not copies: they stay valid until the buffers wrap around again (nsteps steps).
+        :param n_steps: total number of steps, endless by default.
+        :return: dictionaries with the variables and the times 't' of every block.
+        """
+        total = 0
+        while (n_steps is None or total < n_steps) and not self.diverged:
+            start = self.tstep % self.nsteps
+            nblock = min(chunk, self.nsteps - start)
+            if n_steps is not None:
+                nblock = min(nblock, n_steps - total)
+            k, done = self.advance(nblock)
+            total += done
+            if done == 0:
+                break
+            block = dict([(key, self.var[key][start:start + done]) for key in self.keys])
+            block['t'] = self.data.t0 + self.dt * np.arange(self.tstep - done + 1, self.tstep + 1)
+            yield block
+
+    def close(self):
+        """ Stops the worker processes of a sharded network."""
+        if hasattr(self.net, 'close'):
+            self.net.close()
+
+
 class PlotCanvas:
     """ A class to create plots in a canvas located at a given GTK window using
          different threads to be able to visualize runtime simulations.
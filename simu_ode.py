@@ -0,0 +1,174 @@
+import numpy as np
+import logging
+from timeit import default_timer as timer
+from simu_lib import FR_VARS, fr_field, fr_block, write_block
+
+logging.getLogger('simu_ode').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Adaptive step integration of the E/I firing-rate equations.
+
+    FrDopri: (Dormand-Prince 5(4) with error control, dense output on the fixed time grid of Data)
+    ********
+"""
+
+# Dormand-Prince 5(4) tableau
+C = (0.0, 1.0 / 5, 3.0 / 10, 4.0 / 5, 8.0 / 9, 1.0, 1.0)
+A = ((),
+     (1.0 / 5,),
+     (3.0 / 40, 9.0 / 40),
+     (44.0 / 45, -56.0 / 15, 32.0 / 9),
+     (19372.0 / 6561, -25360.0 / 2187, 64448.0 / 6561, -212.0 / 729),
+     (9017.0 / 3168, -355.0 / 33, 46732.0 / 5247, 49.0 / 176, -5103.0 / 18656),
+     (35.0 / 384, 0.0, 500.0 / 1113, 125.0 / 192, -2187.0 / 6784, 11.0 / 84))
+# Error estimate (difference between the 5th and 4th order solutions)
+E = (71.0 / 57600, 0.0, -71.0 / 16695, 71.0 / 1920, -17253.0 / 339200, 22.0 / 525, -1.0 / 40)
+# Dense output (Hairer, Norsett & Wanner)
+D = (-12715105075.0 / 11282082432, 0.0, 87487479700.0 / 32700410799, -10690763975.0 / 1880347072,
+     701980252875.0 / 199316789632, -1453857185.0 / 822651844, 69997945.0 / 29380423)
+
+
+class FrDopri:
+    """ Dormand-Prince 5(4) integrator of the firing-rate equations. The solution is interpolated
+        (4th order dense output) at the points of the fixed grid t = tstep * dt, so its output can be
+        written to the ring buffers of Data exactly as fr_block does.
+    """
+
+    def __init__(self, p, x0, dt, rtol=1e-6, atol=1e-9, hmin=1e-12):
+        """
+        :param p: dictionary of parameters (see conf.txt).
+        :param x0: initial state (re, ve, se, ri, vi, si).
+        :param dt: spacing of the output grid.
+        :param rtol: relative tolerance.
+        :param atol: absolute tolerance.
+        :param hmin: minimum step, below it the solution is considered divergent.
+        """
+        self.logger = logging.getLogger('simu_ode.FrDopri')
+        self.dt = dt
+        self.rtol, self.atol, self.hmin = rtol, atol, hmin
+        self.t = 0.0
+        self.tstep = 0  # Output grid points already produced
+        self.x = np.array(x0, dtype=float)
+        self.h = dt
+        self.steps = self.rejected = 0
+        self.set_params(p)
+
+    def set_params(self, p):
+        """ New parameters: the vector field and its first stage are recomputed."""
+        self.f = fr_field(p)
+        self.k1 = self.f(self.x)
+
+    def _step(self, h):
+        """ One Dormand-Prince step of size h from the current state (not accepted yet).
+        :return: (new state, stages, error norm)
+        """
+        f, x = self.f, self.x
+        k = [self.k1]
+        for i in xrange(1, 7):
+            a = A[i]
+            xi = x + h * sum([a[j] * k[j] for j in xrange(i) if a[j]])
+            k.append(f(xi))
+        xnew = xi  # The 7th stage is evaluated at the 5th order solution (FSAL)
+        err = h * sum([E[j] * k[j] for j in xrange(7) if E[j]])
+        scale = self.atol + self.rtol * np.maximum(np.abs(x), np.abs(xnew))
+        return xnew, k, np.sqrt(np.mean((err / scale) ** 2))
+
+    def integrate(self, tout):
+        """ Advances the solution to the last time of ``tout`` (increasing times, >= current time).
+        :return: array (len(tout), 6) with the dense output at ``tout``; shorter if the solution diverged.
+        """
+        out = np.empty((len(tout), 6))
+        i = 0
+        with np.errstate(all='ignore'):
+            while i < len(tout):
+                h = self.h
+                xnew, k, err = self._step(h)
+                if not np.isfinite(err) or err > 1.0:
+                    self.rejected += 1
+                    self.h = h * max(0.2, 0.9 * err ** -0.2) if np.isfinite(err) else 0.2 * h
+                    if self.h < self.hmin:
+                        self.logger.error("Step size below %g at t = %f." % (self.hmin, self.t))
+                        break
+                    continue
+                # Accepted: interpolate the grid points within [t, t + h]
+                t1 = self.t + h
+                j = np.searchsorted(tout, t1, side='right')
+                if j > i:
+                    x0 = self.x
+                    r2 = xnew - x0
+                    r3 = h * k[0] - r2
+                    r4 = r2 - h * k[6] - r3
+                    r5 = h * sum([D[m] * k[m] for m in xrange(7) if D[m]])
+                    theta = ((tout[i:j] - self.t) / h)[:, np.newaxis]
+                    out[i:j] = x0 + theta * (r2 + (1.0 - theta) * (r3 + theta * (r4 + (1.0 - theta) * r5)))
+                    i = j
+                self.t, self.x, self.k1 = t1, xnew, k[6]
+                self.steps += 1
+                self.h = h * min(5.0, max(0.2, 0.9 * max(err, 1e-10) ** -0.2))
+        return out[:i]
+
+    def block(self, var, k, nblock, nsteps):
+        """ Same as simu_lib.fr_block: writes the next ``nblock`` grid points after index ``k`` of the ring buffers.
+        :return: number of grid points computed.
+        """
+        tout = (self.tstep + np.arange(1, nblock + 1)) * self.dt
+        out = self.integrate(tout)
+        done = len(out)
+        self.tstep += done
+        write_block(var, FR_VARS, k, out)
+        return done
+
+
+def benchmark_dopri(p, x0, dt, tfinal, rtols=None, bisections=8):
+    """ Wall time of the Euler kernel (fr_block) and of FrDopri at equal accuracy, on the same output
+        grid. The accuracy is the maximum error against a reference solution (FrDopri with rtol=1e-11):
+        the target is the error of Euler with step ``dt``, and the tolerance of FrDopri is loosened
+        through ``rtols`` (by default 1e-10 to 1e-1, half a decade apart) and refined by ``bisections``
+        keeping the loosest one whose error does not exceed the target.
+    :return: dictionary with the target error, the dt and the rtol of the pair, their times and errors.
+    """
+    logger = logging.getLogger('simu_ode.benchmark_dopri')
+    nsteps = int(round(tfinal / dt))
+    rtols = 10.0 ** np.arange(-10.0, -0.9, 0.5) if rtols is None else rtols
+
+    def run(method):
+        var = dict([(key, np.empty(nsteps + 1)) for key in FR_VARS])
+        for row, key in enumerate(FR_VARS):
+            var[key][nsteps] = x0[row]
+        time1 = timer()
+        method(var)
+        elapsed = timer() - time1
+        return np.array([var[key][:nsteps] for key in FR_VARS]).T, elapsed
+
+    ref, tref = run(lambda var: FrDopri(p, x0, dt, rtol=1e-11, atol=1e-14).block(var, nsteps, nsteps, nsteps + 1))
+    euler, teuler = run(lambda var: fr_block(var, nsteps, nsteps, p, dt, nsteps + 1))
+    target = np.max(np.abs(euler - ref))
+
+    def dopri(rtol):
+        ode = FrDopri(p, x0, dt, rtol=rtol, atol=rtol * 1e-3)
+        out, elapsed = run(lambda var: ode.block(var, nsteps, nsteps, nsteps + 1))
+        error = np.max(np.abs(out - ref)) if len(out) == nsteps else np.inf
+        return {'dopri_rtol': rtol, 'dopri_time': elapsed, 'dopri_error': error,
+                'dopri_steps': ode.steps, 'dopri_rejected': ode.rejected}
+
+    # Loosest tolerance of the scan within the target, then bisection (in log rtol) up to the next one
+    result, above = None, None
+    for rtol in sorted(rtols):
+        trial = dopri(rtol)
+        if trial['dopri_error'] > target and result is not None:
+            above = rtol
+            break
+        result = trial
+    for _ in xrange(bisections if above is not None else 0):
+        trial = dopri(np.sqrt(result['dopri_rtol'] * above))
+        if trial['dopri_error'] <= target:
+            result = trial
+        else:
+            above = trial['dopri_rtol']
+    result.update({'error': target, 'euler_dt': dt, 'euler_time': teuler, 'euler_error': target,
+                   'speedup': teuler / result['dopri_time']})
+    logger.info("Error %.2e: Euler (dt = %g) %.3f s, Dormand-Prince (rtol = %.1e, error %.2e, %d steps) %.3f s."
+                % (target, dt, teuler, result['dopri_rtol'], result['dopri_error'], result['dopri_steps'],
+                   result['dopri_time']))
+    return result
@@ -0,0 +1,146 @@
+import os
+import sys
+import math
+import time
+import threading
+import cProfile
+import pstats
+import logging
+
+logging.getLogger('simu_prof').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Opt-in profiling of the simulation and GUI processes (--profile, see sconf.parser_init).
+    Nothing in this module is created when profiling is disabled.
+
+    Profiler: (deterministic (cProfile) or sampling profiler of one process, dumped to log/)
+    *********
+    StepTimeHistogram: (histogram of the time per step of every block, dumped to log/)
+    ******************
+"""
+
+
+class Profiler:
+    """ Profiles the process where start() is called:
+            + deterministic: cProfile of the calling thread, dumped as a pstats file (.prof) plus a
+              text summary sorted by cumulative time (.txt).
+            + sampling: a daemon thread records the stack of the calling thread every ``interval``
+              seconds (sys._current_frames), dumped as collapsed stacks (one "f1;f2;f3 count" line per
+              stack, the input of flamegraph.pl) after a summary of the functions with more samples.
+        Files are log/profile_<name>_<pid>.prof|txt.
+    """
+
+    def __init__(self, name, mode='deterministic', logdir='log', interval=0.005):
+        self.logger = logging.getLogger('simu_prof.Profiler')
+        if mode not in ('deterministic', 'sampling'):
+            raise ValueError("Unknown profiling mode '%s'." % mode)
+        self.name, self.mode, self.logdir, self.interval = name, mode, logdir, interval
+        self._profile = None
+        self._thread = None
+        self._running = False
+        self.stacks = {}
+        self.nsamples = 0
+
+    def start(self):
+        self.time = time.time()
+        if self.mode == 'deterministic':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._running = True
+            self._target = threading.current_thread().ident
+            self._thread = threading.Thread(target=self._sample, name='Profiler')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while self._running:
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.nsamples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        """ Stops profiling and writes the dumps.
+        :return: list of the files written.
+        """
+        elapsed = time.time() - self.time
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+        base = os.path.join(self.logdir, 'profile_%s_%d' % (self.name, os.getpid()))
+        files = []
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(base + '.prof')
+            with open(base + '.txt', 'w') as f:
+                pstats.Stats(self._profile, stream=f).sort_stats('cumulative').print_stats(40)
+            files = [base + '.prof', base + '.txt']
+        elif self._thread is not None:
+            self._running = False
+            self._thread.join()
+            leaves = {}
+            for stack, count in self.stacks.items():
+                leaf = stack.rsplit(';', 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            with open(base + '.txt', 'w') as f:
+                f.write("# %d samples every %.1f ms during %.1f s. Functions with more samples:\n"
+                        % (self.nsamples, 1e3 * self.interval, elapsed))
+                for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:40]:
+                    f.write("# %6.2f%%  %s\n" % (100.0 * count / max(self.nsamples, 1), leaf))
+                for stack, count in sorted(self.stacks.items()):
+                    f.write("%s %d\n" % (stack, count))
+            files = [base + '.txt']
+        self.logger.info("Profile (%s) of the %s process saved in %s." % (self.mode, self.name, ', '.join(files)))
+        return files
+
+
+class StepTimeHistogram:
+    """ Histogram of the time per step of the computed blocks, with ``perdecade`` logarithmic bins
+        per decade between ``tmin`` and ``tmax`` seconds (values outside go to the first or last bin).
+    """
+
+    def __init__(self, tmin=1e-8, tmax=1.0, perdecade=10):
+        self.tmin, self.perdecade = tmin, perdecade
+        self.nbins = int(round(math.log10(tmax / tmin) * perdecade))
+        self.counts = [0] * self.nbins
+        self.blocks = 0
+        self.steps = 0
+        self.total = 0.0
+
+    def add(self, elapsed, steps):
+        """ Counts a block of ``steps`` steps computed in ``elapsed`` seconds."""
+        if steps <= 0:
+            return
+        per_step = elapsed / steps
+        index = int(math.log10(max(per_step, self.tmin) / self.tmin) * self.perdecade)
+        self.counts[min(index, self.nbins - 1)] += 1
+        self.blocks += 1
+        self.steps += steps
+        self.total += elapsed
+
+    def edges(self):
+        return [self.tmin * 10 ** (float(i) / self.perdecade) for i in xrange(self.nbins + 1)]
+
+    def dump(self, filename):
+        """ Writes the non-empty bins as "from_us to_us blocks" lines."""
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        edges = self.edges()
+        with open(filename, 'w') as f:
+            f.write("# %d blocks, %d steps, %.3f s, %.3f us per step on average.\n"
+                    % (self.blocks, self.steps, self.total, 1e6 * self.total / max(self.steps, 1)))
+            f.write("# from_us to_us blocks\n")
+            for i, count in enumerate(self.counts):
+                if count:
+                    f.write("%.4g %.4g %d\n" % (1e6 * edges[i], 1e6 * edges[i + 1], count))
+        return filename
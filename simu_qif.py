@@ -0,0 +1,363 @@
+import multiprocessing
+import numpy as np
+import logging
+from timeit import default_timer as timer
+from simu_lib import pi, write_block
+from simu_shm import shared_array, Barrier
+
+logging.getLogger('simu_qif').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Conductance based QIF spiking neural network: two populations (E/I) of N neurons each, with
+    Lorentzian distributed external currents. Equivalent to the firing-rate equations in main.simulation:
+
+        taum * dV/dt = V^2 + eta + I_syn,    V >= vpeak  ->  spike, V = -vpeak
+
+    QifNetwork: (vectorized all to all coupled network)
+    ***********
+    SparseQifNetwork: (random network with fixed in-degree K, spikes propagated through CSR projections)
+    *****************
+    ShardedQifNetwork: (all to all network split in shards integrated by worker processes)
+    ******************
+"""
+
+# Names of the QIF variables in the ring buffers of Data (see Data.population)
+QIF_VARS = ('rqe', 'vqe', 'sqe', 'rqi', 'vqi', 'sqi')
+
+
+def lorentzian(n, center=0.0, width=1.0):
+    """ Deterministic sample of n values of a Lorentzian distribution (equally spaced quantiles)."""
+    j = np.arange(1, n + 1)
+    return center + width * np.tan(pi / 2.0 * (2.0 * j - n - 1) / (n + 1))
+
+
+class QifPopulation:
+    """ Membrane potentials, external currents and refractory state of one population."""
+
+    def __init__(self, n, taum, v0=0.0, r0=0.0, vpeak=100.0, rng=None):
+        rng = rng or np.random
+        self.n = n
+        self.vpeak = vpeak
+        self.taum = taum
+        self.quantiles = lorentzian(n)  # Standard Lorentzian, scaled by delta and shifted by eta
+        self.eta = np.zeros(n)
+        # Initial potentials follow the Lorentzian ansatz of the firing-rate model: center v0, width pi*taum*r0
+        self.v = v0 + pi * taum * max(r0, 0.0) * rng.permutation(lorentzian(n))
+        np.clip(self.v, -vpeak, vpeak, out=self.v)
+        self.release = np.zeros(n, dtype=np.int64)  # Step at which a refractory neuron is released
+        self.spikes = np.empty(0, dtype=np.int64)  # Neurons that fired in the last step
+        self.s = 0.0  # Synaptic activation
+
+    def set_eta(self, center, delta):
+        np.multiply(self.quantiles, delta, out=self.eta)
+        self.eta += center
+
+    def advance(self, tstep, dt, current):
+        """ Euler step of the potentials of the population with a common synaptic current.
+        :return: (number of spikes, sum and number of the non refractory potentials)
+        """
+        v = self.v
+        dv = v * v
+        dv += self.eta
+        dv += current
+        dv *= dt / self.taum
+        v += dv
+        # Refractory neurons are held at -vpeak while the (infinite) excursion lasts
+        refractory = self.release > tstep
+        np.putmask(v, refractory, -self.vpeak)
+        self.spikes = np.flatnonzero(v >= self.vpeak)
+        v[self.spikes] = -self.vpeak
+        # The trajectory takes taum/vpeak to reach infinity and taum/vpeak to come back to -vpeak
+        self.release[self.spikes] = tstep + max(1, int(round(2.0 * self.taum / self.vpeak / dt)))
+        nref = np.count_nonzero(refractory) + len(self.spikes)
+        return len(self.spikes), v.sum() + nref * self.vpeak, self.n - nref
+
+    def step(self, tstep, dt, current):
+        """ Euler step of the potentials of the population with a common synaptic current.
+        :return: (firing rate, mean potential of the non refractory neurons)
+        """
+        nspikes, vsum, nactive = self.advance(tstep, dt, current)
+        return nspikes / (self.n * dt), vsum / max(nactive, 1)
+
+
+class QifNetwork:
+    """ All to all coupled E/I network. The coupling is a mean-field sum: every neuron receives the
+        same synaptic current, so a step costs O(N) operations.
+    """
+
+    def __init__(self, n, prmts, dt, x0=None, vpeak=100.0, seed=None):
+        """
+        :param n: neurons per population.
+        :param prmts: dictionary of parameters (see conf.txt).
+        :param dt: time step.
+        :param x0: initial macroscopic state (re, ve, se, ri, vi, si).
+        :param vpeak: peak and reset potential (+/-).
+        :param seed: seed of the random generator (initial potentials).
+        """
+        self.logger = logging.getLogger('simu_qif.QifNetwork')
+        self.n = int(n)
+        self.dt = dt
+        self.tstep = 0
+        rng = np.random.RandomState(seed)
+        re, ve, se, ri, vi, si = x0 if x0 is not None else (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        self.exc = QifPopulation(self.n, float(prmts['taume']), ve, re, vpeak, rng)
+        self.inh = QifPopulation(self.n, float(prmts['taumi']), vi, ri, vpeak, rng)
+        self.exc.s, self.inh.s = se, si
+        self._prmts = {}
+        self.set_params(prmts)
+        self.logger.debug("QIF network with 2 x %d neurons created." % self.n)
+
+    def set_params(self, prmts):
+        """ Takes new parameters; the external currents are only recomputed if etae, etai or delta changed."""
+        p = dict([(key, float(prmts[key])) for key in ('delta', 'etae', 'etai', 'jc', 'js',
+                                                       'taume', 'taumi', 'taude', 'taudi')])
+        old = self._prmts
+        if [old.get(key) for key in ('delta', 'etae')] != [p['delta'], p['etae']]:
+            self.exc.set_eta(p['etae'], p['delta'])
+        if [old.get(key) for key in ('delta', 'etai')] != [p['delta'], p['etai']]:
+            self.inh.set_eta(p['etai'], p['delta'])
+        self.exc.taum, self.inh.taum = p['taume'], p['taumi']
+        self._prmts = p
+
+    def step(self):
+        """ One Euler step of the network.
+        :return: (re, ve, se, ri, vi, si)
+        """
+        p, dt = self._prmts, self.dt
+        exc, inh = self.exc, self.inh
+        se, si = exc.s, inh.s
+        re, ve = exc.step(self.tstep, dt, -p['taume'] * p['jc'] * si)
+        ri, vi = inh.step(self.tstep, dt, p['taumi'] * p['jc'] * se - p['taumi'] * p['js'] * si)
+        exc.s = se + dt / p['taude'] * (-se + re)
+        inh.s = si + dt / p['taudi'] * (-si + ri)
+        self.tstep += 1
+        return re, ve, exc.s, ri, vi, inh.s
+
+    def block(self, var, k, nblock, nsteps):
+        """ Advances ``nblock`` steps writing the macroscopic variables after index ``k`` of the
+            ring buffers ``var`` (keys in QIF_VARS), as simu_lib.fr_block does.
+        :return: number of steps computed.
+        """
+        out = np.empty((nblock, 6))
+        for n in xrange(nblock):
+            out[n] = self.step()
+        write_block(var, QIF_VARS, k, out)
+        return nblock
+
+
+class SparseProjection:
+    """ Random connectivity with fixed in-degree between two populations, stored in CSR form by
+        presynaptic neuron: the targets of neuron a are indices[indptr[a]:indptr[a + 1]].
+    """
+
+    def __init__(self, npre, npost, k, rng=None):
+        rng = rng or np.random
+        self.npre, self.npost, self.k = npre, npost, k
+        # Every postsynaptic neuron draws its k presynaptic partners uniformly (with replacement). This is the
+        # same as dealing the npost*k synaptic slots randomly among presynaptic neurons: multinomial row
+        # lengths and a random permutation of the targets give the CSR without sorting.
+        self.indptr = np.zeros(npre + 1, dtype=np.int64)
+        np.cumsum(rng.multinomial(npost * k, np.ones(npre) / npre), out=self.indptr[1:])
+        self.indices = np.repeat(np.arange(npost, dtype=np.int32), k)
+        rng.shuffle(self.indices)
+
+    def scatter(self, spikes):
+        """ Number of spikes received by every postsynaptic neuron from the presynaptic ``spikes``."""
+        starts = self.indptr[spikes]
+        lengths = self.indptr[spikes + 1] - starts
+        total = lengths.sum()
+        if total == 0:
+            return np.zeros(self.npost)
+        # Positions of the active rows: ranges [start, start + length) concatenated without a python loop
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        return np.bincount(self.indices[offsets], minlength=self.npost)
+
+    @property
+    def synapses(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.indptr.nbytes
+
+
+class SparseQifNetwork(QifNetwork):
+    """ E/I network with random connectivity of fixed in-degree k. Every neuron has its own synaptic
+        variables, and only the rows of the neurons that fired are scattered each step, so memory
+        and cost scale with k*N and with the number of spikes.
+    """
+
+    def __init__(self, n, prmts, dt, k, x0=None, vpeak=100.0, seed=None):
+        QifNetwork.__init__(self, n, prmts, dt, x0, vpeak, seed)
+        rng = np.random.RandomState(None if seed is None else seed + 1)
+        self.k = int(k)
+        self.ie = SparseProjection(self.n, self.n, self.k, rng)  # I -> E (cross coupling)
+        self.ei = SparseProjection(self.n, self.n, self.k, rng)  # E -> I (cross coupling)
+        self.ii = SparseProjection(self.n, self.n, self.k, rng)  # I -> I (self coupling)
+        # Synaptic activation received by every neuron from each presynaptic population
+        self.s_ie = np.ones(self.n) * self.inh.s
+        self.s_ei = np.ones(self.n) * self.exc.s
+        self.s_ii = np.ones(self.n) * self.inh.s
+        mem = self.memory()
+        self.logger.info("Sparse network: %d synapses, %.1f MB (%.2f MB per million synapses)."
+                         % (mem['synapses'], mem['total'] / 1e6, mem['per_million']))
+
+    def memory(self):
+        """ Memory used by the connectivity and by the state of the network (bytes)."""
+        projections = (self.ie, self.ei, self.ii)
+        synapses = sum([proj.synapses for proj in projections])
+        connectivity = sum([proj.nbytes for proj in projections])
+        state = sum([arr.nbytes for arr in (self.s_ie, self.s_ei, self.s_ii)])
+        for pop in (self.exc, self.inh):
+            state += pop.v.nbytes + pop.eta.nbytes + pop.quantiles.nbytes + pop.release.nbytes
+        return {'synapses': synapses, 'connectivity': connectivity, 'state': state,
+                'total': connectivity + state, 'per_million': connectivity / 1e6 / (synapses / 1e6)}
+
+    def step(self):
+        """ One Euler step of the network.
+        :return: (re, ve, se, ri, vi, si), se and si are the population (mean-field) synaptic variables.
+        """
+        p, dt = self._prmts, self.dt
+        exc, inh = self.exc, self.inh
+        se, si = exc.s, inh.s
+        re, ve = exc.step(self.tstep, dt, -p['taume'] * p['jc'] * self.s_ie)
+        ri, vi = inh.step(self.tstep, dt, p['taumi'] * p['jc'] * self.s_ei - p['taumi'] * p['js'] * self.s_ii)
+        # taud * ds/dt = -s + (spikes received) / (k * dt)
+        for s, proj, pre, taud in ((self.s_ie, self.ie, inh, p['taudi']), (self.s_ei, self.ei, exc, p['taude']),
+                                   (self.s_ii, self.ii, inh, p['taudi'])):
+            s *= 1.0 - dt / taud
+            if len(pre.spikes):
+                s += proj.scatter(pre.spikes) / (self.k * taud)
+        exc.s = se + dt / p['taude'] * (-se + re)
+        inh.s = si + dt / p['taudi'] * (-si + ri)
+        self.tstep += 1
+        return re, ve, exc.s, ri, vi, inh.s
+
+
+def _qif_shard(wid, workers, n, dt, vpeak, shm, start, barrier):
+    """ Worker of ShardedQifNetwork: integrates neurons [lo, hi) of both populations in place in the
+        shared potentials. Each step it publishes its partial sums (spikes, sum of potentials, non
+        refractory neurons) and, after the barrier, reduces all of them in the same order as every
+        other worker, so the synaptic variables stay identical in all the processes.
+    """
+    lo, hi = n * wid // workers, n * (wid + 1) // workers
+    quantiles = lorentzian(n)[lo:hi]
+    prm, partial, out, cmd = shm['prm'], shm['partial'], shm['out'], shm['cmd']
+    pops = []
+    for v in (shm['ve'], shm['vi']):
+        pop = QifPopulation(hi - lo, 1.0, vpeak=vpeak)
+        pop.v = v[lo:hi]
+        pop.quantiles = quantiles
+        pops.append(pop)
+    exc, inh = pops
+    se, si = shm['s']
+    tstep = 0
+    eta = None
+    while True:
+        start.wait()
+        nblock = int(cmd[0])
+        if nblock < 0:
+            break
+        delta, etae, etai, jc, js, taume, taumi, taude, taudi = prm
+        exc.taum, inh.taum = taume, taumi
+        if eta != (delta, etae, etai):
+            eta = (delta, etae, etai)
+            exc.set_eta(etae, delta)
+            inh.set_eta(etai, delta)
+        for j in xrange(nblock):
+            buf = partial[tstep % 2]
+            buf[wid, 0:3] = exc.advance(tstep, dt, -taume * jc * si)
+            buf[wid, 3:6] = inh.advance(tstep, dt, taumi * jc * se - taumi * js * si)
+            barrier.wait()
+            total = buf.sum(axis=0)
+            re, ve = total[0] / (n * dt), total[1] / max(total[2], 1)
+            ri, vi = total[3] / (n * dt), total[4] / max(total[5], 1)
+            se += dt / taude * (-se + re)
+            si += dt / taudi * (-si + ri)
+            if wid == 0:
+                out[j] = (re, ve, se, ri, vi, si)
+            tstep += 1
+        start.wait()
+
+
+class ShardedQifNetwork:
+    """ All to all network whose neurons are split among ``workers`` processes. The potentials live
+        in shared memory and every worker integrates its own shard in place; per step only the
+        partial sums are reduced through a (double buffered) shared array and a barrier.
+        It follows the interface of QifNetwork (set_params, block) plus close().
+    """
+    PRMTS = ('delta', 'etae', 'etai', 'jc', 'js', 'taume', 'taumi', 'taude', 'taudi')
+
+    def __init__(self, n, prmts, dt, workers, x0=None, vpeak=100.0, seed=None, maxblock=10000):
+        self.logger = logging.getLogger('simu_qif.ShardedQifNetwork')
+        self.n = int(n)
+        self.workers = int(workers)
+        self.maxblock = maxblock
+        # The initial state is the one of the serial network, so both versions integrate the same system
+        serial = QifNetwork(self.n, prmts, dt, x0, vpeak, seed)
+        self.shm = {'ve': shared_array(self.n, init=serial.exc.v), 'vi': shared_array(self.n, init=serial.inh.v),
+                    's': (serial.exc.s, serial.inh.s),
+                    'prm': shared_array(len(self.PRMTS)), 'cmd': shared_array(1),
+                    'partial': shared_array((2, self.workers, 6)), 'out': shared_array((maxblock, 6))}
+        del serial
+        self.set_params(prmts)
+        self._start = Barrier(self.workers + 1)
+        self._barrier = Barrier(self.workers)
+        self.procs = []
+        for wid in xrange(self.workers):
+            proc = multiprocessing.Process(target=_qif_shard, args=(wid, self.workers, self.n, dt, vpeak, self.shm,
+                                                                    self._start, self._barrier))
+            proc.daemon = True
+            proc.start()
+            self.procs.append(proc)
+        self.logger.debug("QIF network with 2 x %d neurons in %d shards." % (self.n, self.workers))
+
+    def set_params(self, prmts):
+        """ Parameters are read by the workers at the beginning of every block."""
+        self.shm['prm'][:] = [float(prmts[key]) for key in self.PRMTS]
+
+    def run(self, nblock):
+        """ Advances ``nblock`` (<= maxblock) steps.
+        :return: view of the (nblock, 6) macroscopic variables (re, ve, se, ri, vi, si).
+        """
+        self.shm['cmd'][0] = nblock
+        self._start.wait()
+        self._start.wait()
+        return self.shm['out'][:nblock]
+
+    def block(self, var, k, nblock, nsteps):
+        """ Same as QifNetwork.block."""
+        done = 0
+        while done < nblock:
+            n = min(self.maxblock, nblock - done)
+            out = self.run(n)
+            write_block(var, QIF_VARS, k + done, out)
+            done += n
+        return nblock
+
+    def close(self):
+        if self.procs:
+            self.shm['cmd'][0] = -1
+            self._start.wait()
+            for proc in self.procs:
+                proc.join()
+            self.procs = []
+
+
+def sharded_scaling(n, prmts, dt, workers=(1, 2, 4, 8, 16), nblock=2000):
+    """ Steps per second of ShardedQifNetwork for different numbers of workers.
+    :return: dictionary workers -> steps/s.
+    """
+    logger = logging.getLogger('simu_qif.sharded_scaling')
+    x0 = (0.5, -0.5, 0.5, 0.5, -0.5, 0.5)
+    result = {}
+    for nw in workers:
+        net = ShardedQifNetwork(n, prmts, dt, nw, x0=x0, seed=0)
+        net.run(10)
+        time1 = timer()
+        net.run(nblock)
+        result[nw] = nblock / (timer() - time1)
+        net.close()
+        logger.info("%2d workers: %.0f steps/s" % (nw, result[nw]))
+    return result
@@ -0,0 +1,459 @@
+import time
+import tempfile
+import multiprocessing
+import numpy as np
+import logging
+
+logging.getLogger('simu_shm').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Shared memory tools for the simulation processes.
+
+    shared_array: (numpy view of a lock-free multiprocessing.RawArray)
+    *************
+    Barrier: (reusable barrier for a fixed number of processes)
+    ********
+    MinMaxPyramid: (incremental min/max decimation levels of ring buffers, envelopes of M points in O(M))
+    **************
+    SharedVars: (ring buffers of Data.vars in shared memory, write index published with a sequence counter)
+    ***********
+    SharedParams: (fixed layout block with the numeric parameters of Data.prmts and a version counter)
+    *************
+    Control: (pause/resume/step/stop/exit channel between the GUI and the simulation process)
+    ********
+    Counters: (performance counters in shared memory, written by the simulation and the GUI)
+    *********
+"""
+
+
+def shared_array(shape, dtype=np.float64, init=None, directory=None):
+    """ Numpy array whose buffer is a multiprocessing.RawArray (no lock), so it is shared by the
+        processes forked after its creation. With a ``directory`` it is a np.memmap on an (already
+        unlinked) temporary file of that directory instead, also shared with the forked processes
+        but kept in the page cache rather than in anonymous memory (see simu_lib.ring_buffer).
+    :param shape: shape of the array.
+    :param dtype: numpy dtype of the elements.
+    :param init: optional initial values.
+    :param directory: directory of the memory-mapped file (None: RawArray).
+    :return: numpy array.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    if directory is not None and size:
+        with tempfile.TemporaryFile(prefix='shm_', dir=directory) as f:
+            arr = np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+    else:
+        raw = multiprocessing.RawArray('b', max(size * dtype.itemsize, 1))
+        arr = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+    if init is not None:
+        arr[...] = init
+    return arr
+
+
+class Barrier:
+    """ Reusable barrier for ``parties`` processes (multiprocessing has no Barrier in python 2).
+        Two turnstiles make it safe to call wait() again right after leaving it.
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = multiprocessing.RawValue('i', 0)
+        self.mutex = multiprocessing.Lock()
+        self.turnstile = multiprocessing.Semaphore(0)
+        self.turnstile2 = multiprocessing.Semaphore(0)
+
+    def wait(self):
+        with self.mutex:
+            self.count.value += 1
+            if self.count.value == self.parties:
+                for _ in xrange(self.parties):
+                    self.turnstile.release()
+        self.turnstile.acquire()
+        with self.mutex:
+            self.count.value -= 1
+            if self.count.value == 0:
+                for _ in xrange(self.parties):
+                    self.turnstile2.release()
+        self.turnstile2.acquire()
+
+
+class MinMaxPyramid:
+    """ Minimum and maximum of the ring buffers ``arrays`` over bins of ``branch``, ``branch**2``, ...
+        slots, stored in shared memory as one (nvars, nbins) array per level. After a block is written,
+        update() only recomputes the bins that contain the new slots (O(block) work), and envelope()
+        reads the coarsest level that still resolves the requested number of points.
+        Bins are aligned with the slots of the ring buffers, so the bin that contains the write
+        position mixes the newest and the oldest samples.
+        The levels take about 2 / (branch - 1) of the memory of the buffers: with a ``directory``
+        (Data.mmap) they are memory-mapped there, like the buffers, instead of held in RAM.
+    """
+
+    def __init__(self, arrays, keys, dtype=np.float64, branch=8, minbins=64, directory=None):
+        self.arrays = arrays
+        self.keys = list(keys)
+        self.row = dict([(key, i) for i, key in enumerate(self.keys)])
+        self.nsteps = len(arrays[self.keys[0]])
+        self.branch = branch
+        self.mins, self.maxs = [], []
+        nbins = self.nsteps
+        while (nbins + branch - 1) // branch >= minbins:
+            nbins = (nbins + branch - 1) // branch
+            self.mins.append(shared_array((len(self.keys), nbins), dtype, directory=directory))
+            self.maxs.append(shared_array((len(self.keys), nbins), dtype, directory=directory))
+        self.update(0, self.nsteps)
+
+    @property
+    def levels(self):
+        return len(self.mins)
+
+    def update(self, start, n):
+        """ Recomputes the bins of the ``n`` slots written from slot ``start`` (it may wrap around)."""
+        if not self.mins:
+            return
+        n = min(n, self.nsteps)
+        end = start + n
+        segments = [(start, min(end, self.nsteps))]
+        if end > self.nsteps:
+            segments.append((0, end - self.nsteps))
+        for a, b in segments:
+            size = 1
+            lower = None
+            for mins, maxs in zip(self.mins, self.maxs):
+                # Bins of this level that contain slots [a, b) and the sub-bins (or slots) they cover
+                ja, jb = a // (size * self.branch), (b + size * self.branch - 1) // (size * self.branch)
+                la, lb = ja * self.branch, min(jb * self.branch, (self.nsteps + size - 1) // size)
+                index = np.arange(0, lb - la, self.branch)
+                if lower is None:
+                    for key, i in self.row.items():
+                        values = self.arrays[key][la:lb]
+                        mins[i, ja:jb] = np.minimum.reduceat(values, index)
+                        maxs[i, ja:jb] = np.maximum.reduceat(values, index)
+                else:
+                    mins[:, ja:jb] = np.minimum.reduceat(lower[0][:, la:lb], index, axis=1)
+                    maxs[:, ja:jb] = np.maximum.reduceat(lower[1][:, la:lb], index, axis=1)
+                lower = (mins, maxs)
+                size *= self.branch
+
+    def envelope(self, key, offset, i0, i1, npoints):
+        """ Envelope of the buffer ``key`` between the positions ``i0`` and ``i1`` counted from
+            slot ``offset`` (the oldest sample), reduced to about ``npoints`` points.
+        :return: (positions, minimum, maximum), positions are the first position of each point.
+        """
+        i0, i1 = max(int(i0), 0), min(int(i1), self.nsteps)
+        n = i1 - i0
+        if n <= 0:
+            empty = np.empty(0)
+            return empty.astype(int), empty, empty
+        level = int(np.log(max(n / float(npoints), 1.0)) / np.log(self.branch))
+        level = min(level, self.levels)
+        if level == 0:
+            positions = np.arange(i0, i1)
+            values = self.arrays[key][(offset + positions) % self.nsteps]
+            return positions, values, values
+        size = self.branch ** level
+        mins, maxs = self.mins[level - 1][self.row[key]], self.maxs[level - 1][self.row[key]]
+        start, end = offset + i0, offset + i1
+        segments = [(start, min(end, self.nsteps), 0)]
+        if end > self.nsteps:
+            segments = [(start, self.nsteps, 0)] if start < self.nsteps else []
+            segments.append((max(start - self.nsteps, 0), end - self.nsteps, self.nsteps))
+        positions, ymin, ymax = [], [], []
+        for a, b, shift in segments:
+            ja, jb = a // size, (b + size - 1) // size
+            positions.append(np.maximum(np.arange(ja, jb) * size, a) + shift - offset)
+            ymin.append(mins[ja:jb])
+            ymax.append(maxs[ja:jb])
+        positions, ymin, ymax = np.concatenate(positions), np.concatenate(ymin), np.concatenate(ymax)
+        if len(positions) > npoints:
+            index = np.unique(np.linspace(0, len(positions), npoints, endpoint=False).astype(int))
+            positions = positions[index]
+            ymin, ymax = np.minimum.reduceat(ymin, index), np.maximum.reduceat(ymax, index)
+        return positions, ymin, ymax
+
+
+class SharedVars:
+    """ Shared memory copy of the variables of Data (Data.vars), with numpy views in the configured dtype.
+        The simulation writes without locks; the write index (tstep) is published with a sequence
+        counter so readers can take consistent snapshots:
+
+            writer: begin(nblock) -> write the block -> publish(tstep)
+            reader: seq, tstep, pending = snapshot() -> read views -> check sequence == seq
+
+        While a block is being written (pending > 0) the ``pending`` oldest samples of the ring
+        buffers are not valid. Memory-mapped buffers of the same dtype (Data with --mmap) are
+        already shared with the forked processes and are used without copying them.
+        With ``pyramid`` the published blocks also update a MinMaxPyramid, read with envelope(),
+        whose levels are memory-mapped in ``directory`` if given (Data.mmap).
+    """
+
+    def __init__(self, variables, dtype=np.float64, pyramid=True, directory=None):
+        self.logger = logging.getLogger('simu_shm.SharedVars')
+        self.dtype = np.dtype(dtype)
+        self.arrays = {}
+        for key, value in variables.items():
+            if isinstance(value, np.memmap) and (value.dtype == self.dtype or key == 't'):
+                self.arrays[key] = value
+            elif isinstance(value, np.ndarray):
+                self.arrays[key] = shared_array(value.shape, self.dtype, init=value)
+        self._state = shared_array(3, np.int64)  # sequence, tstep, pending
+        self._state[1] = variables.get('tstep', 0)
+        self.nsteps = len(variables['t'])
+        keys = sorted([key for key in self.arrays if key != 't'])
+        self.pyramid = MinMaxPyramid(self.arrays, keys, self.dtype, directory=directory) if pyramid and keys else None
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def begin(self, nblock):
+        """ Writer: the next ``nblock`` samples are going to be overwritten."""
+        self._state[2] = nblock
+        self._state[0] += 1
+
+    def publish(self, tstep):
+        """ Writer: the block is written and ``tstep`` steps have been computed."""
+        if self.pyramid is not None:
+            last = int(self._state[1])
+            new = tstep - last if tstep > last else self.nsteps
+            self.pyramid.update(last % self.nsteps, new)
+        self._state[1] = tstep
+        self._state[2] = 0
+        self._state[0] += 1
+
+    @property
+    def sequence(self):
+        return int(self._state[0])
+
+    @property
+    def tstep(self):
+        return self.snapshot()[1]
+
+    def snapshot(self):
+        """ Reader: consistent (sequence, tstep, pending) of the ring buffers."""
+        state = self._state
+        while True:
+            seq = state[0]
+            tstep, pending = state[1], state[2]
+            if state[0] == seq:
+                return int(seq), int(tstep), int(pending)
+
+    def ordered(self, key, tstep, pending=0, stride=1):
+        """ Reader: samples of the ring buffer ``key`` from the oldest to the newest, taking one of
+            every ``stride``. Only the selected samples are copied.
+        """
+        start = tstep % self.nsteps + pending
+        index = np.arange(start, start + self.nsteps - pending, stride) % self.nsteps
+        return self.arrays[key][index]
+
+    def envelope(self, key, tstep, i0, i1, npoints):
+        """ Reader: minimum and maximum of ``key`` over about ``npoints`` intervals between the
+            positions ``i0`` and ``i1`` (0 is the oldest sample, see ordered()).
+        :return: (positions, minimum, maximum).
+        """
+        if self.pyramid is None:
+            positions = np.arange(max(int(i0), 0), min(int(i1), self.nsteps))
+            values = self.arrays[key][(tstep + positions) % self.nsteps]
+            return positions, values, values
+        return self.pyramid.envelope(key, tstep % self.nsteps, i0, i1, npoints)
+
+
+class SharedParams:
+    """ Parameters shared between the GUI and the simulation: one float64 slot per numeric key of
+        Data.prmts plus a version counter. The GUI writes a slot and increases the version; the
+        simulation only compares one integer per block and copies the block when it changed.
+    """
+
+    def __init__(self, prmts):
+        self.logger = logging.getLogger('simu_shm.SharedParams')
+        self.keys = sorted([key for key, value in prmts.items()
+                            if isinstance(value, (int, float)) and not isinstance(value, bool)])
+        self.index = dict([(key, i) for i, key in enumerate(self.keys)])
+        self.types = dict([(key, type(prmts[key])) for key in self.keys])
+        self.values = shared_array(len(self.keys), np.float64, init=[prmts[key] for key in self.keys])
+        self._version = shared_array(1, np.int64)
+        self._stamp = shared_array(1, np.float64)  # time.time() of the last change
+
+    def __setitem__(self, key, value):
+        self.values[self.index[key]] = float(value)
+        self._stamp[0] = time.time()
+        self._version[0] += 1
+
+    @property
+    def stamp(self):
+        return float(self._stamp[0])
+
+    def __getitem__(self, key):
+        return self.types[key](self.values[self.index[key]])
+
+    @property
+    def version(self):
+        return int(self._version[0])
+
+    def update(self, p):
+        """ Copies the parameters into the dictionary ``p``.
+        :return: the version of the copied values.
+        """
+        while True:
+            version = self._version[0]
+            values = self.values.tolist()
+            if self._version[0] == version:
+                break
+        for key, value in zip(self.keys, values):
+            p[key] = self.types[key](value)
+        return int(version)
+
+
+class Control:
+    """ Control channel between the GUI and the simulation process. Commands are written in shared
+        memory and signalled through a multiprocessing.Condition: a paused simulation sleeps in
+        wait() without using CPU, a running one only reads one integer between blocks.
+        Every command is time-stamped, and the simulation stores the delay with which it took it.
+        The time the simulation spends sleeping in wait() is accumulated in ``idle`` (seconds, in
+        the simulation process).
+    """
+    PAUSE, RUN, STOP, EXIT = range(4)
+
+    def __init__(self, paused=True):
+        self.logger = logging.getLogger('simu_shm.Control')
+        self._cond = multiprocessing.Condition()
+        # command, steps allowed while paused, command sequence, acknowledged sequence
+        self._state = shared_array(4, np.int64)
+        self._times = shared_array(2, np.float64)  # time stamp of the last command, latency of the last ack
+        self.idle = 0.0
+        self.reset(paused)
+
+    def _send(self, command, steps=0):
+        with self._cond:
+            self._state[0] = command
+            self._state[1] = steps
+            self._times[0] = time.time()
+            self._state[2] += 1
+            self._cond.notify_all()
+
+    # GUI side
+    def reset(self, paused=True):
+        self._send(self.PAUSE if paused else self.RUN)
+
+    def pause(self):
+        self._send(self.PAUSE)
+
+    def resume(self):
+        self._send(self.RUN)
+
+    def advance(self, steps):
+        """ Runs exactly ``steps`` steps and pauses again."""
+        self._send(self.PAUSE, steps)
+
+    def stop(self):
+        self._send(self.STOP)
+
+    def exit(self):
+        self._send(self.EXIT)
+
+    @property
+    def latency(self):
+        """ Seconds the simulation took to take the last acknowledged command."""
+        return float(self._times[1])
+
+    @property
+    def pending(self):
+        """ True if the simulation has not taken the last command yet."""
+        return self._state[2] != self._state[3]
+
+    # Simulation side
+    @property
+    def command(self):
+        return int(self._state[0])
+
+    @property
+    def stopped(self):
+        return self._state[0] in (self.STOP, self.EXIT)
+
+    def _ack(self):
+        if self._state[3] != self._state[2]:
+            self._state[3] = self._state[2]
+            self._times[1] = time.time() - self._times[0]
+
+    def wait(self):
+        """ Blocks while the simulation is paused.
+        :return: maximum number of steps that can be computed before checking again (None: no limit),
+                 0 if the simulation must stop.
+        """
+        state = self._state
+        if state[0] == self.RUN and state[2] == state[3]:
+            return None
+        with self._cond:
+            while state[0] == self.PAUSE and state[1] == 0:
+                self._ack()
+                time1 = time.time()
+                self._cond.wait()
+                self.idle += time.time() - time1
+            self._ack()
+            self._granted = int(state[2])
+            if state[0] == self.RUN:
+                return None
+            if state[0] == self.PAUSE:
+                return int(state[1])
+            return 0
+
+    def consume(self, steps):
+        """ Discounts computed steps from the ones allowed by advance() (unless a new command arrived)."""
+        state = self._state
+        if state[0] == self.PAUSE and state[1] > 0:
+            with self._cond:
+                if state[2] == getattr(self, '_granted', None):
+                    state[1] = max(state[1] - steps, 0)
+
+
+class Counters:
+    """ Cumulative performance counters in shared memory, one float64 slot per name. Every slot has a
+        single writer (the simulation or the GUI), so add() needs no lock; readers take periodic
+        samples and compute rates from the differences:
+
+            steps, compute: steps computed and seconds spent computing them (simulation).
+            blocks, control: blocks and seconds spent between blocks (commands, parameters, progress bar).
+            params, param_latency: parameter changes taken and seconds from the GUI write to the integrator.
+            frames, frame_time: plot frames drawn and seconds spent on them (GUI).
+            snapshots, snapshot_time: snapshots of the shared variables and seconds spent on them (GUI).
+    """
+    names = ('steps', 'compute', 'blocks', 'control', 'params', 'param_latency', 'frames', 'frame_time',
+             'snapshots', 'snapshot_time')
+
+    def __init__(self):
+        self.index = dict([(name, i) for i, name in enumerate(self.names)])
+        self.values = shared_array(len(self.names), np.float64)
+
+    def add(self, name, value=1.0):
+        self.values[self.index[name]] += value
+
+    def __getitem__(self, name):
+        return float(self.values[self.index[name]])
+
+    def sample(self):
+        """ Copy of all the counters, with the time of the sample in 'time'."""
+        sample = dict(zip(self.names, self.values.tolist()))
+        sample['time'] = time.time()
+        return sample
+
+    @staticmethod
+    def rates(new, old):
+        """ Rates and mean costs between two samples.
+        :return: dictionary with 'steps/s', 'compute' and 'control' (fractions of the wall time),
+                 'control/block' (s), 'param_latency' (s), 'frame_time' (s) and 'snapshot_time' (s).
+                 Means without events in the interval are None.
+        """
+        diff = dict([(name, new[name] - old[name]) for name in Counters.names])
+        wall = max(new['time'] - old['time'], 1e-9)
+
+        def mean(total, count):
+            return diff[total] / diff[count] if diff[count] else None
+        return {'steps/s': diff['steps'] / wall, 'compute': diff['compute'] / wall,
+                'control': diff['control'] / wall, 'control/block': mean('control', 'blocks'),
+                'param_latency': mean('param_latency', 'params'), 'frame_time': mean('frame_time', 'frames'),
+                'snapshot_time': mean('snapshot_time', 'snapshots')}
@@ -0,0 +1,102 @@
+import numpy as np
+import logging
+
+logging.getLogger('simu_spec').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Online spectral analysis of the simulated variables (--freqAnalysis).
+
+    WelchPSD: (running Welch power spectral density and dominant frequency, updated block by block)
+    *********
+"""
+
+# Variables analysed by --freqAnalysis, their dominant frequency is stored in the ring buffer 'f' + name
+FREQ_VARS = ('re', 'ri', 'se', 'si')
+
+
+class WelchPSD:
+    """ Welch estimate of the power spectral density of several signals, fed with consecutive
+        blocks of samples as the simulation computes them. The samples are decimated by block
+        averaging to get segments of ``nfft`` points covering ``window`` time units; every
+        ``hop`` new points a Hann-tapered segment is transformed and added to an exponential
+        average of ``navg`` segments, so the estimate follows changes of the parameters.
+        The cost of an update is O(block) plus one FFT per completed segment (O(log nfft) per sample).
+        Frequencies are in cycles per time unit of the model.
+    """
+
+    def __init__(self, names, dt, window=20.0, nfft=1024, overlap=0.5, navg=8):
+        self.logger = logging.getLogger('simu_spec.WelchPSD')
+        self.names = list(names)
+        self.decimate = max(int(round(window / (nfft * dt))), 1)
+        self.fs = 1.0 / (dt * self.decimate)
+        self.nfft, self.navg = nfft, navg
+        self.hop = max(int(nfft * (1.0 - overlap)), 1)
+        self.freqs = np.fft.rfftfreq(nfft, 1.0 / self.fs)
+        self.taper = np.hanning(nfft)
+        self.scale = 1.0 / (self.fs * np.sum(self.taper ** 2))
+        self.reset()
+        self.logger.debug("Segments of %d points at %g samples per time unit (resolution %g)."
+                          % (nfft, self.fs, self.freqs[1]))
+
+    def reset(self):
+        nvars = len(self.names)
+        self.psd = np.zeros((nvars, len(self.freqs)))
+        self.segments = 0
+        self._rest = np.empty((nvars, 0))  # Samples waiting to complete a decimation bin
+        self._buffer = np.empty((nvars, 2 * self.nfft))
+        self._n = 0
+
+    def update(self, block):
+        """ Adds a block of samples.
+        :param block: array (nvars, n), one row per signal in the order of ``names``.
+        :return: number of segments added to the estimate.
+        """
+        data = np.hstack((self._rest, np.asarray(block, dtype=float)))
+        m = data.shape[1] // self.decimate * self.decimate
+        self._rest = data[:, m:]
+        if self.decimate > 1:
+            data = data[:, :m].reshape(len(self.names), -1, self.decimate).mean(axis=2)
+        else:
+            data = data[:, :m]
+        added = 0
+        i = 0
+        while i < data.shape[1]:
+            take = min(data.shape[1] - i, 2 * self.nfft - self._n)
+            self._buffer[:, self._n:self._n + take] = data[:, i:i + take]
+            self._n += take
+            i += take
+            while self._n >= self.nfft:
+                self._segment(self._buffer[:, :self.nfft])
+                added += 1
+                self._buffer[:, :self._n - self.hop] = self._buffer[:, self.hop:self._n]
+                self._n -= self.hop
+        return added
+
+    def _segment(self, segment):
+        x = segment - np.mean(segment, axis=1)[:, np.newaxis]
+        spectrum = np.abs(np.fft.rfft(x * self.taper, axis=1)) ** 2 * self.scale
+        spectrum[:, 1:-1] *= 2.0  # One-sided
+        self.segments += 1
+        self.psd += (spectrum - self.psd) / min(self.segments, self.navg)
+
+    def dominant(self):
+        """ Frequency of the highest peak (excluding the DC bin) of every signal, refined by
+            parabolic interpolation, and the fraction of the power in the peak.
+        :return: (frequencies, fractions), arrays of length nvars (zeros before the first segment).
+        """
+        nvars = len(self.names)
+        if not self.segments:
+            return np.zeros(nvars), np.zeros(nvars)
+        psd = self.psd[:, 1:]
+        peak = np.argmax(psd, axis=1)
+        rows = np.arange(nvars)
+        left = psd[rows, np.maximum(peak - 1, 0)]
+        center = psd[rows, peak]
+        right = psd[rows, np.minimum(peak + 1, psd.shape[1] - 1)]
+        curvature = left - 2.0 * center + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+            fraction = (left + center + right) / np.sum(psd, axis=1)
+        frequencies = (peak + 1 + np.clip(delta, -0.5, 0.5)) * self.freqs[1]
+        return frequencies, np.nan_to_num(fraction)
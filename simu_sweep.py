@@ -0,0 +1,492 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import logging
+from timeit import default_timer as timer
+from simu_lib import FR_VARS, pi, pi2
+from simu_bif import fixed_point
+
+logging.getLogger('simu_sweep').addHandler(logging.NullHandler())
+
+__author__ = 'Jose M. Esnaola Acebes'
+
+""" Batch integration of the E/I firing-rate model over many parameter sets at once.
+
+    fr_sweep: (integrates P parameter sets as one (P, 6) state array)
+    *********
+    sweep_grid: (builds the parameter arrays of a regular grid around the parameters in Data)
+    ***********
+    run_sweep: (runs a sweep in chunks on a process pool, storing the results in a SweepStore)
+    **********
+    sample_initial_states: (grid or random initial states (P, 6) over some of the variables)
+    **********************
+    label_attractors: (groups the trajectories of a batch by the fixed point or limit cycle they reach)
+    *****************
+    basin_map: (integrates P initial states at once and labels the attractor reached by each one)
+    **********
+"""
+
+# Parameters of the firing-rate equations (see conf.txt)
+FR_PARAMS = ('delta', 'etae', 'etai', 'jc', 'js', 'taume', 'taumi', 'taude', 'taudi')
+
+
+def initial_state(data):
+    """ Initial state (re, ve, se, ri, vi, si) stored in the ring buffers of a Data object."""
+    k = data.nsteps - 1
+    return np.array([data.vars[key][k] for key in FR_VARS], dtype=float)
+
+
+def sweep_grid(base, **ranges):
+    """ Cartesian product of the given parameter values. Parameters not given are taken from
+        ``base`` (usually Data.prmts).
+    :param base: dictionary of default parameters.
+    :param ranges: parameter name -> sequence of values, e.g. etae=np.linspace(-5, 5, 100).
+    :return: dictionary parameter -> array of shape (P,), with P the product of the range lengths.
+    """
+    names = [key for key in FR_PARAMS if key in ranges]
+    unknown = set(ranges) - set(FR_PARAMS)
+    if unknown:
+        raise KeyError('Unknown parameter(s): %s' % ', '.join(sorted(unknown)))
+    grids = np.meshgrid(*[np.asarray(ranges[key], dtype=float) for key in names], indexing='ij')
+    size = grids[0].size if grids else 1
+    prm = dict([(key, grid.ravel()) for key, grid in zip(names, grids)])
+    for key in FR_PARAMS:
+        if key not in prm:
+            prm[key] = np.ones(size) * float(base[key])
+    return prm
+
+
+class FrBatch:
+    """ Forward Euler integration of P copies of the E/I firing-rate model, each with its own
+        parameters. It uses the same discretization as simu_lib.fr_block (the synaptic variables
+        are updated with the new rates), the state is stored as (6, P) rows for contiguous
+        vectorized updates.
+    """
+
+    def __init__(self, prmts, x0, dt):
+        """
+        :param prmts: dictionary parameter -> scalar or array of shape (P,).
+        :param x0: initial state, shape (6,) (shared by all the sets) or (P, 6).
+        :param dt: time step.
+        """
+        self.logger = logging.getLogger('simu_sweep.FrBatch')
+        x0 = np.asarray(x0, dtype=float)
+        size = max([np.size(prmts[key]) for key in FR_PARAMS] + [x0.size // 6])
+        self.size = size
+        self.dt = float(dt)
+        self.x = np.empty((6, size))
+        self.x[:] = x0.T if x0.ndim == 2 else x0[:, np.newaxis]
+        self.set_params(prmts)
+        self._tmp = np.empty((4, size))
+
+    def set_params(self, prmts):
+        """ Pre-computes the constant terms of the vector field for every parameter set."""
+        p = dict([(key, np.ones(self.size) * np.asarray(prmts[key], dtype=float)) for key in FR_PARAMS])
+        dt = self.dt
+        self.dte, self.dti = dt / p['taume'], dt / p['taumi']
+        self.dtse, self.dtsi = dt / p['taude'], dt / p['taudi']
+        self.ce = p['delta'] / pi / p['taume']
+        self.ci = p['delta'] / p['taumi'] / pi
+        self.pe = pi2 * p['taume'] ** 2
+        self.pin = pi2 * p['taumi'] ** 2
+        self.etae, self.etai = p['etae'], p['etai']
+        self.jce, self.jci, self.jsi = p['taume'] * p['jc'], p['taumi'] * p['jc'], p['taumi'] * p['js']
+
+    def step(self):
+        """ One Euler step for the whole batch, in place."""
+        re, ve, se, ri, vi, si = self.x
+        dre, dve, dri, dvi = self._tmp
+        # dre = dte * (ce + 2 re ve)
+        np.multiply(re, ve, out=dre)
+        dre *= 2.0
+        dre += self.ce
+        dre *= self.dte
+        # dve = dte * (ve^2 + etae - pe re^2 - jce si)
+        np.multiply(ve, ve, out=dve)
+        dve += self.etae
+        dve -= self.pe * re * re
+        dve -= self.jce * si
+        dve *= self.dte
+        # dri = dti * (ci + 2 ri vi)
+        np.multiply(ri, vi, out=dri)
+        dri *= 2.0
+        dri += self.ci
+        dri *= self.dti
+        # dvi = dti * (vi^2 + etai - pi ri^2 + jci se - jsi si)
+        np.multiply(vi, vi, out=dvi)
+        dvi += self.etai
+        dvi -= self.pin * ri * ri
+        dvi += self.jci * se
+        dvi -= self.jsi * si
+        dvi *= self.dti
+
+        re += dre
+        ve += dve
+        ri += dri
+        vi += dvi
+        se += self.dtse * (re - se)
+        si += self.dtsi * (ri - si)
+
+    def run(self, tsteps, window=0):
+        """ Integrates ``tsteps`` steps and collects statistics over the last ``window`` steps.
+        :return: dictionary with 'final', 'mean', 'min', 'max' (shape (P, 6)) and 'diverged' (P,).
+        """
+        window = int(min(window, tsteps))
+        with np.errstate(all='ignore'):
+            for _ in xrange(tsteps - window):
+                self.step()
+            xsum = np.zeros_like(self.x)
+            xmin = self.x.copy()
+            xmax = self.x.copy()
+            for _ in xrange(window):
+                self.step()
+                xsum += self.x
+                np.minimum(xmin, self.x, out=xmin)
+                np.maximum(xmax, self.x, out=xmax)
+            xmean = xsum / window if window else self.x.copy()
+        diverged = ~np.all(np.isfinite(self.x), axis=0)
+        return {'final': self.x.T.copy(), 'mean': xmean.T, 'min': xmin.T, 'max': xmax.T, 'diverged': diverged}
+
+
+def fr_sweep(prmts, x0, dt, tfinal, window=None):
+    """ Integrates the firing-rate model for every parameter set in ``prmts`` (see sweep_grid).
+    :param prmts: dictionary parameter -> scalar or array of shape (P,).
+    :param x0: initial state, shape (6,) or (P, 6).
+    :param dt: time step.
+    :param tfinal: total time of integration.
+    :param window: length (in time units) of the trailing window for the statistics, 10% of tfinal by default.
+    :return: dictionary with 'final', 'mean', 'min', 'max' (shape (P, 6)), 'diverged' (P,) and the parameters.
+    """
+    logger = logging.getLogger('simu_sweep.fr_sweep')
+    tsteps = int(np.ceil(tfinal / dt))
+    window = 0.1 * tfinal if window is None else window
+    batch = FrBatch(prmts, x0, dt)
+    logger.debug("Integrating %d parameter sets, %d steps." % (batch.size, tsteps))
+    time1 = timer()
+    result = batch.run(tsteps, int(round(window / dt)))
+    elapsed = timer() - time1
+    logger.info("%d parameter sets integrated in %.2f s (%.0f set-steps/s). %d diverged."
+                % (batch.size, elapsed, batch.size * tsteps / elapsed, np.sum(result['diverged'])))
+    result['parameters'] = dict([(key, np.ones(batch.size) * prmts[key]) for key in FR_PARAMS])
+    result['time'] = elapsed
+    return result
+
+
+def sweep_signature(prmts, x0, dt, tsteps, window, chunksize):
+    """ Description of a sweep stored in the header of its SweepStore: two sweeps with the same
+        signature compute the same chunks.
+    :return: dictionary (JSON serializable).
+    """
+    digest = hashlib.sha1()
+    for key in FR_PARAMS:
+        digest.update(np.ascontiguousarray(prmts[key], dtype=float).tobytes())
+    return {'parameters': digest.hexdigest(), 'size': int(np.size(prmts[FR_PARAMS[0]])), 'chunksize': int(chunksize),
+            'dt': float(dt), 'tsteps': int(tsteps), 'window': int(window),
+            'x0': [float(value) for value in np.ravel(x0)]}
+
+
+class SweepStore:
+    """ Append-only results file of a sweep. The first record is a header with the signature of the
+        sweep (see sweep_signature), then every chunk is stored as one .npy record with a row per
+        parameter set: [index, parameters (9), final (6), mean (6), min (6), max (6), diverged].
+        Records are flushed and synced to disk as they arrive; a truncated record (killed sweep)
+        is discarded when the file is opened again. A file written by a different sweep is not resumed.
+    """
+    columns = (['index'] + list(FR_PARAMS) + ['%s_%s' % (stat, key) for stat in ('final', 'mean', 'min', 'max')
+                                              for key in FR_VARS] + ['diverged'])
+
+    def __init__(self, filename, signature=None):
+        self.logger = logging.getLogger('simu_sweep.SweepStore')
+        self.filename = filename
+        self.signature = signature
+        self.done = set()
+        self.rows = 0
+        if os.path.exists(filename) and os.path.getsize(filename):
+            self._recover()
+        elif signature is not None:
+            with open(filename, 'wb') as f:
+                np.save(f, np.array(json.dumps(signature, sort_keys=True)))
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _header(record):
+        """ Signature stored in a header record, None for a chunk record."""
+        if record.dtype.kind in 'SU':
+            return json.loads(str(record))
+        return None
+
+    def _recover(self):
+        """ Checks the header and reads the complete records, truncating the file after the last one."""
+        good = 0
+        header = None
+        with open(self.filename, 'rb') as f:
+            while True:
+                try:
+                    record = np.load(f)
+                except (IOError, ValueError, EOFError):
+                    break
+                if good == 0 and self._header(record) is not None:
+                    header = self._header(record)
+                else:
+                    self.done.add(int(record[0, 0]))
+                    self.rows += len(record)
+                good = f.tell()
+        if self.signature is not None and header != json.loads(json.dumps(self.signature)):
+            raise ValueError("%s was written by a different sweep (grid, chunksize, dt, tfinal, window or initial "
+                             "state), use another output file." % self.filename)
+        if good != os.path.getsize(self.filename):
+            self.logger.warning("Discarding an incomplete record at the end of %s." % self.filename)
+            with open(self.filename, 'r+b') as f:
+                f.truncate(good)
+        self.logger.info("%d chunks (%d parameter sets) already in %s."
+                         % (len(self.done), self.rows, self.filename))
+
+    def append(self, record):
+        """ Appends the results of a chunk (array with one row per parameter set)."""
+        with open(self.filename, 'ab') as f:
+            np.save(f, record)
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.add(int(record[0, 0]))
+        self.rows += len(record)
+
+    def load(self):
+        """ All the stored rows, sorted by parameter-set index."""
+        records = []
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                while f.tell() < os.path.getsize(self.filename):
+                    record = np.load(f)
+                    if self._header(record) is None:
+                        records.append(record)
+        if not records:
+            return np.empty((0, len(self.columns)))
+        table = np.concatenate(records)
+        return table[np.argsort(table[:, 0])]
+
+
+def _sweep_chunk(task):
+    """ Worker function of run_sweep: integrates one chunk and packs it as a SweepStore record."""
+    first, prmts, x0, dt, tsteps, window = task
+    result = FrBatch(prmts, x0, dt).run(tsteps, window)
+    size = len(result['final'])
+    index = np.arange(first, first + size)[:, np.newaxis]
+    params = np.column_stack([np.ones(size) * prmts[key] for key in FR_PARAMS])
+    return np.hstack((index, params, result['final'], result['mean'], result['min'], result['max'],
+                      result['diverged'][:, np.newaxis]))
+
+
+def run_sweep(prmts, x0, dt, tfinal, filename, window=None, chunksize=1000, workers=None):
+    """ Splits the parameter sets in chunks of ``chunksize`` and integrates them on a process pool.
+        Chunks already stored in ``filename`` are skipped, so an interrupted sweep resumes where it stopped
+        (the file must have been written by the same sweep, see SweepStore).
+    :param prmts: dictionary parameter -> array of shape (P,) (see sweep_grid).
+    :param x0: initial state, shape (6,).
+    :param filename: results file (see SweepStore).
+    :param workers: number of processes, all the cores by default.
+    :return: the SweepStore.
+    """
+    logger = logging.getLogger('simu_sweep.run_sweep')
+    tsteps = int(np.ceil(tfinal / dt))
+    window = int(round((0.1 * tfinal if window is None else window) / dt))
+    size = max([np.size(prmts[key]) for key in FR_PARAMS])
+    prmts = dict([(key, np.ones(size) * prmts[key]) for key in FR_PARAMS])
+    store = SweepStore(filename, sweep_signature(prmts, x0, dt, tsteps, window, chunksize))
+
+    tasks = []
+    for first in xrange(0, size, chunksize):
+        if first not in store.done:
+            chunk = dict([(key, prmts[key][first:first + chunksize]) for key in FR_PARAMS])
+            tasks.append((first, chunk, x0, dt, tsteps, window))
+    nchunks = (size + chunksize - 1) // chunksize
+    logger.info("Sweep of %d parameter sets: %d of %d chunks pending." % (size, len(tasks), nchunks))
+    if not tasks:
+        return store
+
+    nsets = sum([np.size(task[1]['etae']) for task in tasks])
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    time1 = timer()
+    try:
+        for n, record in enumerate(pool.imap_unordered(_sweep_chunk, tasks)):
+            store.append(record)
+            logger.debug("Chunk %d/%d stored (%.1f s)." % (n + 1, len(tasks), timer() - time1))
+        pool.close()
+    except BaseException as exc:
+        # Any error (a worker exception, a failed append, Ctrl-C) stops the workers before joining them
+        if isinstance(exc, KeyboardInterrupt):
+            logger.warning("Sweep interrupted, %d chunks stored. Run again to resume." % len(store.done))
+        else:
+            logger.error("Sweep failed, %d chunks stored. Run again to resume." % len(store.done))
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    elapsed = timer() - time1
+    logger.info("%d chunks in %.1f s with %d workers (%.0f set-steps/s)."
+                % (len(tasks), elapsed, workers, nsets * tsteps / elapsed))
+    return store
+
+
+def sample_initial_states(n, ranges, base, mode='random', seed=None):
+    """ Initial states of the firing-rate model sampled over some of the variables.
+    :param n: number of states. A grid has m points per variable, with m^d the closest to ``n``.
+    :param ranges: variable name (see FR_VARS) -> (min, max), e.g. {'re': (0, 3), 've': (-3, 3)}.
+    :param base: state (6,) giving the variables that are not sampled.
+    :param mode: 'grid' (regular grid, ordered as np.meshgrid with indexing='ij') or 'random' (uniform).
+    :return: (x0, shape), the states (P, 6) and the shape of the grid (None for random states).
+    """
+    names = [key for key in FR_VARS if key in ranges]
+    unknown = set(ranges) - set(FR_VARS)
+    if unknown:
+        raise KeyError('Unknown variable(s): %s' % ', '.join(sorted(unknown)))
+    if mode == 'grid':
+        m = max(int(round(n ** (1.0 / len(names)))), 2)
+        grids = np.meshgrid(*[np.linspace(ranges[key][0], ranges[key][1], m) for key in names], indexing='ij')
+        samples = [grid.ravel() for grid in grids]
+        shape = grids[0].shape
+    elif mode == 'random':
+        rng = np.random.RandomState(seed)
+        samples = [rng.uniform(ranges[key][0], ranges[key][1], n) for key in names]
+        shape = None
+    else:
+        raise ValueError("Unknown sampling mode '%s'." % mode)
+    x0 = np.empty((len(samples[0]), 6))
+    x0[:] = np.asarray(base, dtype=float)
+    for key, sample in zip(names, samples):
+        x0[:, FR_VARS.index(key)] = sample
+    return x0, shape
+
+
+# Labels of the trajectories that did not reach an attractor (see label_attractors)
+DIVERGED, NOT_CONVERGED = -1, -2
+
+
+def label_attractors(result, prmts, previous=None, tol=1e-3, ctol=1e-2, decay=0.9):
+    """ Labels the attractor reached by every trajectory of a FrBatch.run result. A trajectory goes to
+        a fixed point when its oscillation over the window (max - min, relative to 1 + |mean|) is below
+        ``tol``, or when it is still decaying (below ``decay`` times its oscillation in the ``previous``
+        window, the FrBatch.run result just before) towards a stable fixed point. Otherwise it is on a
+        limit cycle. Fixed points are found by simu_bif.fixed_point from the mean states, grouped with
+        relative tolerance ``ctol``; limit cycles are grouped by their extremes (min and max of every
+        variable over both windows). A trajectory on a cycle whose extremes still change between the
+        ``previous`` window and the last one (by more than ``tol``) has not converged yet: it is not
+        assigned to any attractor.
+    :return: (labels, attractors), labels (P,) index of the attractor (NOT_CONVERGED, DIVERGED), and a list of
+             dictionaries with 'type', 'state' (the fixed point, or the mean state of the cycle), 'min',
+             'max', 'count' and, for fixed points, 'stability'.
+    """
+    def oscillation(stats):
+        with np.errstate(invalid='ignore'):
+            return np.max((stats['max'] - stats['min']) / (1.0 + np.abs(stats['mean'])), axis=1)
+
+    def close_to(features, ref):
+        return np.all(np.abs(features - ref) <= ctol * (1.0 + np.abs(ref)), axis=1)
+
+    size = len(result['final'])
+    labels = np.ones(size, dtype=int) * DIVERGED
+    attractors = []
+    amplitude = oscillation(result)
+    alive = ~result['diverged'] & np.isfinite(amplitude)
+    with np.errstate(invalid='ignore'):
+        still = alive & (amplitude < tol)
+        decaying = alive & ~still
+        if previous is not None:
+            decaying &= amplitude < decay * oscillation(previous)
+        else:
+            decaying[:] = False
+    xmin, xmax = result['min'], result['max']
+    if previous is not None:
+        xmin, xmax = np.minimum(xmin, previous['min']), np.maximum(xmax, previous['max'])
+
+    # Fixed points
+    pending = np.flatnonzero(still | decaying)
+    while pending.size:
+        close = close_to(result['mean'][pending], result['mean'][pending[0]])
+        members = pending[close]
+        pending = pending[~close]
+        fp = fixed_point(prmts, result['mean'][members].mean(axis=0))
+        stable = fp is not None and fp['stability'].startswith('stable')
+        if not stable:
+            # Trajectories do not decay towards an unstable fixed point: slow cycles (period longer than the window)
+            decaying[members] = False
+            members = members[still[members]]
+            if not members.size:
+                continue
+        state = fp['x'] if fp is not None else result['mean'][members].mean(axis=0)
+        for n, attractor in enumerate(attractors):
+            if close_to(attractor['state'][np.newaxis], state)[0]:
+                labels[members] = n
+                attractor['count'] += len(members)
+                attractor['min'] = np.minimum(attractor['min'], xmin[members].min(axis=0))
+                attractor['max'] = np.maximum(attractor['max'], xmax[members].max(axis=0))
+                break
+        else:
+            labels[members] = len(attractors)
+            attractors.append({'type': 'fixed point', 'state': state, 'count': len(members),
+                               'stability': fp['stability'] if fp is not None else 'unknown',
+                               'min': xmin[members].min(axis=0), 'max': xmax[members].max(axis=0)})
+
+    # Limit cycles, only those trajectories whose extremes did not change between both windows
+    extremes = np.hstack((xmin, xmax))
+    cycles = alive & ~still & ~decaying
+    if previous is not None:
+        last, before = np.hstack((result['min'], result['max'])), np.hstack((previous['min'], previous['max']))
+        with np.errstate(invalid='ignore'):
+            converged = np.max(np.abs(last - before) / (1.0 + np.abs(last)), axis=1) < tol
+        labels[cycles & ~converged] = NOT_CONVERGED
+        cycles &= converged
+    pending = np.flatnonzero(cycles)
+    while pending.size:
+        close = close_to(extremes[pending], extremes[pending[0]])
+        members = pending[close]
+        pending = pending[~close]
+        labels[members] = len(attractors)
+        attractors.append({'type': 'limit cycle', 'state': result['mean'][members].mean(axis=0),
+                           'count': len(members), 'min': xmin[members].min(axis=0),
+                           'max': xmax[members].max(axis=0)})
+    return labels, attractors
+
+
+def basin_map(prmts, x0, dt, tfinal, window=None, tol=1e-3, ctol=1e-2):
+    """ Basins of attraction of the firing-rate model for one parameter set: all the initial states
+        are integrated together as one FrBatch, then every trajectory is labelled (see label_attractors).
+        The statistics are taken over the two halves of the trailing window, so that trajectories
+        still decaying towards a fixed point are not taken as cycles; ``tfinal`` should anyway be
+        longer than the transients.
+    :param prmts: dictionary of (scalar) parameters.
+    :param x0: initial states, shape (P, 6) (see sample_initial_states).
+    :param window: length (in time units) of the trailing window for the statistics, 10% of tfinal by default.
+    :return: dictionary with 'x0', 'labels', 'attractors', 'final' and the 'timing' (seconds and set-steps/s).
+    """
+    logger = logging.getLogger('simu_sweep.basin_map')
+    tsteps = int(np.ceil(tfinal / dt))
+    window = 0.1 * tfinal if window is None else window
+    batch = FrBatch(prmts, x0, dt)
+    logger.debug("Integrating %d initial states, %d steps." % (batch.size, tsteps))
+    time1 = timer()
+    half = int(round(0.5 * window / dt))
+    previous = batch.run(tsteps - half, half)
+    result = batch.run(half, half)
+    time2 = timer()
+    labels, attractors = label_attractors(result, prmts, previous, tol, ctol)
+    time3 = timer()
+    timing = {'integration': time2 - time1, 'labelling': time3 - time2,
+              'set-steps/s': batch.size * tsteps / (time2 - time1)}
+    logger.info("%d initial states integrated in %.2f s (%.0f set-steps/s), labelled in %.3f s."
+                % (batch.size, timing['integration'], timing['set-steps/s'], timing['labelling']))
+    for n, attractor in enumerate(attractors):
+        re, ri = attractor['state'][0], attractor['state'][3]
+        logger.info("Attractor %d: %s at re = %.4f, ri = %.4f (%.1f%% of the states)."
+                    % (n, attractor.get('stability', attractor['type']), re, ri,
+                       100.0 * attractor['count'] / batch.size))
+    if np.any(labels == NOT_CONVERGED):
+        logger.warning("Not converged: %d states (%.1f%%) still approaching a cycle, increase tfinal or the window."
+                       % (np.sum(labels == NOT_CONVERGED), 100.0 * np.sum(labels == NOT_CONVERGED) / batch.size))
+    if np.any(labels == DIVERGED):
+        logger.info("Diverged: %.1f%% of the states." % (100.0 * np.sum(labels == DIVERGED) / batch.size))
+    return {'x0': np.asarray(x0, dtype=float), 'labels': labels, 'attractors': attractors,
+            'final': result['final'], 'timing': timing}
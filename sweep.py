@@ -0,0 +1,48 @@
+#!/usr/bin/python2.7
+
+import numpy as np
+from sconf import parser_init, parser, log_conf
+from simu_lib import Data
+from simu_sweep import sweep_grid, initial_state, run_sweep, FR_PARAMS
+
+__author__ = 'jm'
+
+""" Headless parameter sweep of the E/I firing-rate model, using all the cores.
+    The grid is declared in sweep_conf.txt (or any file given with -f). Results are appended
+    chunk by chunk to the output file, running the same command again resumes the sweep.
+"""
+
+# -- Simulation configuration I: parsing, debugging.
+conf_file, debug, args1, hlp = parser_init(default_file="sweep_conf.txt")
+if not hlp:
+    logger = log_conf(debug, name='sweep')
+else:
+    logger = None
+# -- Simulation configuration II: data entry (second parser).
+description = 'Parameter sweep of the E/I firing-rate model.'
+opts, args = parser(conf_file, args1, description=description)
+
+
+def grid_ranges(prmts):
+    """ Parameters declared as [start, stop, num] are turned into arrays of num values."""
+    ranges = {}
+    for key in FR_PARAMS:
+        value = prmts[key]
+        if isinstance(value, list):
+            if len(value) == 1:
+                prmts[key] = value[0]
+            elif len(value) == 3:
+                ranges[key] = np.linspace(value[0], value[1], int(value[2]))
+            else:
+                raise ValueError("Parameter %s must be a value or [start, stop, num]." % key)
+    return ranges
+
+
+if __name__ == '__main__':
+    ranges = grid_ranges(opts['parameters'])
+    logger.info("Swept parameters: %s" % ', '.join(sorted(ranges.keys())))
+    data = Data(opts)
+    prm = sweep_grid(data.prmts, **ranges)
+    store = run_sweep(prm, initial_state(data), data.dt, data.tfinal, args.out, window=args.window,
+                      chunksize=args.chunk, workers=args.workers or None)
+    logger.info("%d parameter sets stored in %s." % (store.rows, args.out))